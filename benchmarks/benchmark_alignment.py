@@ -0,0 +1,53 @@
+"""
+Compare the run time of the alignment engines on random sequences.
+
+Run from the root of the repository with:
+python -m benchmarks.benchmark_alignment
+"""
+
+import random
+import time
+
+from src.alignment import ENGINES, compare_sequences
+
+QUERY_LENGTHS = [100, 1000, 10000]
+CONTIG_LENGTH = 200
+
+
+def random_sequence(length):
+    return "".join(random.choice("ATCG") for _ in range(length))
+
+
+def time_engine(query, contig, engine, score_only):
+    start = time.perf_counter()
+    result = compare_sequences(query, contig, 1, -1, -1, 0, engine, score_only)
+    return time.perf_counter() - start, result
+
+
+def main():
+    random.seed(7712)
+    contig = random_sequence(CONTIG_LENGTH)
+    print(f"contig length: {CONTIG_LENGTH}")
+    modes = [(engine, score_only) for score_only in [False, True] for engine in ENGINES]
+    print(
+        "query_length\t"
+        + "\t".join(
+            f"{engine}{'_score_only' if score_only else ''}_seconds"
+            for engine, score_only in modes
+        )
+    )
+    for query_length in QUERY_LENGTHS:
+        query = random_sequence(query_length)
+        times = []
+        results = []
+        for engine, score_only in modes:
+            seconds, result = time_engine(query, contig, engine, score_only)
+            times.append(seconds)
+            results.append(result)
+        if any(result != results[0] for result in results):
+            raise Exception(f"engines disagree for query length {query_length}")
+        print(f"{query_length}\t" + "\t".join(f"{seconds:.4f}" for seconds in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Compare the memory used per kmer and per contig on the sample data.
+
+Objects with a per-instance __dict__ (how Kmer, Contig and Paths used to be stored)
+are compared with the slotted classes and with the arrays of a KmerTable.
+
+Run from the root of the repository with:
+python -m benchmarks.benchmark_memory
+"""
+
+import contextlib
+import io
+import tracemalloc
+
+from src.assembly import Contig, assembly
+from src.data_loader import parse_reads
+from src.graph import Paths, graph_traversal
+from src.kmers import Kmer, create_kmer_table
+
+SAMPLES = [("sample_data/fake_READS.fasta", 30), ("sample_data/READS.100.fasta", 20)]
+
+
+class DictKmer:
+    def __init__(self, read_id, id, code, k, start, stop, direction):
+        self.read_id = read_id
+        self.id = id
+        self.code = code
+        self.k = k
+        self.start = start
+        self.stop = stop
+        self.direction = direction
+
+
+class DictContig:
+    def __init__(self, contig_id, aligned_reads, sequence, direction):
+        self.contig_id = contig_id
+        self.sequence = sequence
+        self.direction = direction
+        self.aligned_reads = aligned_reads
+
+    def add_kmers(self, kmers):
+        self.kmers = kmers
+
+    def add_seeds(self, seeds):
+        self.seeds = seeds
+
+
+class DictPaths:
+    def __init__(self, contig_id, start_node, stop_node, path):
+        self.contig_id = contig_id
+        self.start_node = start_node
+        self.stop_node = stop_node
+        self.path = path
+
+
+def traced_bytes(build):
+    """
+    measure the memory allocated while building objects
+
+    Args:
+        build (function): function that builds the objects
+
+    Returns:
+        int: bytes still allocated after building
+    """
+    tracemalloc.start()
+    objects = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def build_contigs(cls, rows):
+    contigs = []
+    for row in rows:
+        contig = cls(*row)
+        contig.add_kmers([])
+        contig.add_seeds([])
+        contigs.append(contig)
+    return contigs
+
+
+def main():
+    print(
+        "reads\tk\tkmers\tdict_bytes_per_kmer\tslots_bytes_per_kmer\ttable_bytes_per_kmer"
+        "\tcontigs\tdict_bytes_per_contig\tslots_bytes_per_contig"
+        "\tdict_bytes_per_path\tslots_bytes_per_path"
+    )
+    for fp, k in SAMPLES:
+        read_dict = parse_reads(fp)
+        table = create_kmer_table(read_dict, k, 0, 1)
+        # the same field values are shared by both classes so only the objects are measured
+        kmer_rows = [
+            (kmer.read_id, kmer.id, kmer.code, kmer.k, kmer.start, kmer.stop, 1)
+            for kmer in table
+        ]
+        dict_kmer = traced_bytes(lambda: [DictKmer(*row) for row in kmer_rows])
+        slots_kmer = traced_bytes(lambda: [Kmer(*row) for row in kmer_rows])
+        table_kmer = sum(
+            array.nbytes
+            for array in [table.read_index, table.id, table.code, table.start]
+            + [table.direction]
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            paths = list(graph_traversal(table, False, None))
+            contigs = assembly(paths, table)
+        path_rows = [(p.contig_id, p.start_node, p.stop_node, p.path) for p in paths]
+        contig_rows = [
+            (c.contig_id, c.aligned_reads, c.sequence, c.direction) for c in contigs
+        ]
+        dict_contig = traced_bytes(lambda: build_contigs(DictContig, contig_rows))
+        slots_contig = traced_bytes(lambda: build_contigs(Contig, contig_rows))
+        dict_path = traced_bytes(lambda: [DictPaths(*row) for row in path_rows])
+        slots_path = traced_bytes(lambda: [Paths(*row) for row in path_rows])
+        n_kmers = len(kmer_rows)
+        n_contigs = len(contig_rows)
+        n_paths = len(path_rows)
+        print(
+            f"{fp}\t{k}\t{n_kmers}\t{dict_kmer / n_kmers:.1f}\t{slots_kmer / n_kmers:.1f}"
+            f"\t{table_kmer / n_kmers:.1f}\t{n_contigs}\t{dict_contig / n_contigs:.1f}"
+            f"\t{slots_contig / n_contigs:.1f}\t{dict_path / n_paths:.1f}"
+            f"\t{slots_path / n_paths:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
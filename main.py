@@ -13,12 +13,30 @@ are assembled into contigs using a de Bruijn graph.
 import argparse as arg
 import datetime
 
-from src.alignment import alignment
+from src.alignment import align_queries, alignment
 from src.assembly import assembly
-from src.data_loader import parse_query, parse_reads
+from src.cache import (
+    StageCache,
+    arrays_to_contigs,
+    arrays_to_counts,
+    arrays_to_paths,
+    cached_stage,
+    contigs_to_arrays,
+    counts_to_arrays,
+    file_digest,
+    paths_to_arrays,
+    stage_key,
+)
+from src.data_loader import (
+    IndexedReads,
+    is_gzipped,
+    parse_queries,
+    parse_query,
+    parse_reads,
+)
 from src.graph import graph_traversal
-from src.kmers import get_all_kmers
-from src.output import save_required_ouputs
+from src.kmers import count_kmers, get_all_kmers, kmer_counting
+from src.output import save_query_outputs, save_required_ouputs
 
 parser = arg.ArgumentParser(
     description="Align sequence reads to a query sequence and assemble contigs from aligned reads"
@@ -75,37 +93,232 @@ parser.add_argument(
 parser.add_argument(
     "--s", "-save", type=bool, help="if True, save intermediate outputs", default=False
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--n",
+    "-allow_n",
+    type=bool,
+    help="if True, accept N bases and mask the kmers that contain them",
+    default=False,
+)
+parser.add_argument(
+    "--c",
+    "-canonical",
+    type=bool,
+    help="if True, assemble reads from both strands by keying kmers on the smaller of the kmer and its reverse complement",
+    default=False,
+)
+parser.add_argument(
+    "--mc",
+    "-min_kmer_count",
+    type=int,
+    help="kmers that occur fewer times in the reads are dropped before the graph is built",
+    default=1,
+)
+parser.add_argument(
+    "--e",
+    "-engine",
+    type=str,
+    choices=["python", "numpy", "batch"],
+    help="how to compute alignment scores: all give the same scores, numpy is faster than python and batch aligns contigs of similar length together",
+    default="batch",
+)
+parser.add_argument(
+    "--w",
+    "-workers",
+    type=int,
+    help="number of processes to use for aligning contigs",
+    default=1,
+)
+parser.add_argument(
+    "--b",
+    "-band",
+    type=int,
+    help="extend alignments only this many diagonals around the kmer matches, contigs with scattered matches are aligned in full",
+    default=None,
+)
+parser.add_argument(
+    "--tb",
+    "-traceback",
+    type=bool,
+    help="if True, find the coordinates and CIGAR string of each alignment and save them with the alignment scores",
+    default=False,
+)
+parser.add_argument(
+    "--mq",
+    "-multi_query",
+    type=bool,
+    help="if True, the query file may hold several queries: contigs are assembled once and aligned to each query, with outputs in one directory per query",
+    default=False,
+)
+parser.add_argument(
+    "--mp",
+    "-max_paths",
+    type=int,
+    help="maximum number of paths through the graph to assemble into contigs",
+    default=None,
+)
+parser.add_argument(
+    "--cd",
+    "-cache_dir",
+    type=str,
+    help="directory to cache kmer counts, graph paths and contigs in, so runs that only change alignment parameters skip assembly",
+    default=None,
+)
+parser.add_argument(
+    "--cs",
+    "-cache_size",
+    type=int,
+    help="maximum size of the cache in megabytes, the least recently used entries are removed",
+    default=1024,
+)
+
+
+def assemble_reads(
+    read_dict, k, canonical, min_kmer_count, max_paths, save, out_dir, cache, inputs
+):
+    """
+    count kmers, find the paths through the graph and assemble them into contigs
+
+    Each stage is loaded from the cache when its inputs were seen before.
+
+    Args:
+        read_dict (dict): read ids (keys) and sequences (values)
+        k (int): kmer size
+        canonical (bool): whether to key kmers by their canonical code
+        min_kmer_count (int): kmers that occur fewer times are dropped
+        max_paths (int): maximum number of paths to find (no limit if None)
+        save (bool): whether to save intermediate outputs, stages are then always run
+        out_dir (str): directory to save intermediate outputs
+        cache (StageCache): cache of stage outputs, or None to always run the stages
+        inputs (touple): hash of the reads file and settings that change the kmers
+
+    Returns:
+        list: instances of class Contig
+    """
+    solid_kmers = None
+    if min_kmer_count > 1 or save:
+        kmer_counts = cached_stage(
+            cache,
+            stage_key("kmers", *inputs),
+            lambda: count_kmers(read_dict, k, canonical),
+            counts_to_arrays,
+            arrays_to_counts,
+            save,
+        )
+        solid_kmers = kmer_counting(
+            read_dict, k, canonical, min_kmer_count, save, out_dir, kmer_counts
+        )
+    # kmers are made in batches of reads, once to build the graph and again to find the
+    # reads on each path, so the kmers of all reads are never held in memory at once
+    read_kmers = get_all_kmers(read_dict, k, canonical, solid_kmers, lazy=True)
+    paths = cached_stage(
+        cache,
+        stage_key("paths", *inputs, min_kmer_count, max_paths),
+        lambda: list(graph_traversal(read_kmers, save, out_dir, max_paths)),
+        paths_to_arrays,
+        arrays_to_paths,
+        save,
+    )
+    read_kmers = get_all_kmers(read_dict, k, canonical, solid_kmers, lazy=True)
+    return assembly(paths, read_kmers)
 
 
-query_seq = parse_query(args.q)
-print(f"{datetime.datetime.now()}: parsed query files")
-read_dict, rvs_read_dict = parse_reads(args.r)
-print(f"{datetime.datetime.now()}: parsed reads files")
-out_dir = args.o
-k = args.k
-match_score = args.m
-gap_score = args.g
-mismatch_score = args.mi
-threshold = args.t
-save = args.s
+# the pipeline only runs when called as a script, so worker processes can import this module
+if __name__ == "__main__":
+    args = parser.parse_args()
 
+    allow_n = args.n
+    multi_query = args.mq
+    if multi_query:
+        query_dict = parse_queries(args.q, allow_n)
+    else:
+        query_seq = parse_query(args.q, allow_n)
+    print(f"{datetime.datetime.now()}: parsed query files")
+    if is_gzipped(args.r):
+        read_dict = parse_reads(args.r, allow_n)
+    else:
+        # only read ids and offsets are kept in memory, sequences are read from the file when needed
+        read_dict = IndexedReads(args.r, allow_n)
+    print(f"{datetime.datetime.now()}: parsed reads files")
+    out_dir = args.o
+    k = args.k
+    match_score = args.m
+    gap_score = args.g
+    mismatch_score = args.mi
+    threshold = args.t
+    save = args.s
+    max_paths = args.mp
+    engine = args.e
+    band = args.b
+    traceback = args.tb
+    workers = args.w
+    canonical = args.c
+    min_kmer_count = args.mc
 
-read_kmers = get_all_kmers(read_dict, rvs_read_dict, k)
-print(f"{datetime.datetime.now()}: created kmers")
-paths = graph_traversal(read_kmers, save, out_dir)
-all_contigs = assembly(paths, read_kmers)
-aligned_contigs = alignment(
-    query_seq=query_seq,
-    contigs=all_contigs,
-    k=k,
-    match_score=match_score,
-    gap_score=gap_score,
-    mismatch_score=mismatch_score,
-    threshold=threshold,
-    save=save,
-    out_dir=out_dir,
-)
-print(f"{datetime.datetime.now()}: formatting output")
-save_required_ouputs(aligned_contigs, out_dir)
-print(f"{datetime.datetime.now()}: done")
+    cache = None
+    reads_digest = None
+    if args.cd is not None:
+        cache = StageCache(args.cd, args.cs * 1024 * 1024)
+        reads_digest = file_digest(args.r)
+        print(f"{datetime.datetime.now()}: hashed reads file")
+    # alignment parameters are left out, so changing them reuses the cached contigs
+    inputs = (reads_digest, k, canonical, allow_n)
+    all_contigs = cached_stage(
+        cache,
+        stage_key("contigs", *inputs, min_kmer_count, max_paths),
+        lambda: assemble_reads(
+            read_dict,
+            k,
+            canonical,
+            min_kmer_count,
+            max_paths,
+            save,
+            out_dir,
+            cache,
+            inputs,
+        ),
+        contigs_to_arrays,
+        arrays_to_contigs,
+        save,
+    )
+    print(f"{datetime.datetime.now()}: assembled contigs")
+    if multi_query:
+        # contigs are assembled once and shared by all queries
+        query_results = align_queries(
+            query_dict=query_dict,
+            contigs=all_contigs,
+            k=k,
+            match_score=match_score,
+            gap_score=gap_score,
+            mismatch_score=mismatch_score,
+            threshold=threshold,
+            save=save,
+            out_dir=out_dir,
+            engine=engine,
+            workers=workers,
+            band=band,
+            traceback=traceback,
+            canonical=canonical,
+        )
+        print(f"{datetime.datetime.now()}: formatting output")
+        save_query_outputs(query_results, out_dir)
+    else:
+        aligned_contigs = alignment(
+            query_seq=query_seq,
+            contigs=all_contigs,
+            k=k,
+            match_score=match_score,
+            gap_score=gap_score,
+            mismatch_score=mismatch_score,
+            threshold=threshold,
+            save=save,
+            out_dir=out_dir,
+            engine=engine,
+            workers=workers,
+            band=band,
+            traceback=traceback,
+            canonical=canonical,
+        )
+        print(f"{datetime.datetime.now()}: formatting output")
+        save_required_ouputs(aligned_contigs, out_dir)
+    print(f"{datetime.datetime.now()}: done")
@@ -7,46 +7,219 @@ Functions needed to align reads to query sequence
 
 import csv
 import datetime
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
-from src.kmers import create_contig_kmers, create_query_kmers
+from src.kmers import create_query_kmers, encode_kmers, reverse_complement
 
+# files a run writes into its output directory, which no query directory may be named
+OUTPUT_FILES = (
+    "adjacency_matrix.csv",
+    "alignment_scores.csv",
+    "ALLELES.aln",
+    "ALLELES.fasta",
+    "edge_list.csv",
+    "kmer_spectrum.csv",
+    "query_summary.csv",
+)
 
-def get_contigs_to_align(query_seq, contigs, k):
+
+class NoAlignmentError(Exception):
+    """
+    raised when no contig aligns to the query sequence
+    """
+
+
+def index_query_kmers(query_seq, k):
+    """
+    index the kmers of the query sequence by their code
+
+    Args:
+        query_seq (str): sequence to align against
+        k (int): kmer size
+
+    Returns:
+        dict: kmer codes (keys) and list of start positions in the query (values)
+    """
+    query_index = {}
+    for kmer in create_query_kmers(query_seq, k, lazy=True):
+        if kmer.code in query_index:
+            query_index[kmer.code].append(kmer.start)
+        else:
+            query_index[kmer.code] = [kmer.start]
+    return query_index
+
+
+def find_seeds(query_index, sequence, k):
+    """
+    find all exact kmer matches between a sequence and the query
+
+    Args:
+        query_index (dict): query kmers made by index_query_kmers
+        sequence (str): contig sequence
+        k (int): kmer size
+
+    Returns:
+        list: touples of the start position in the query and start position in the contig of each match
+    """
+    seeds = []
+    for contig_start, code in encode_kmers(sequence, k):
+        query_starts = query_index.get(code)
+        if query_starts is not None:
+            for query_start in query_starts:
+                seeds.append((query_start, contig_start))
+    return seeds
+
+
+def index_contig_kmers(contigs, k):
+    """
+    index the kmers of all contigs by their code, so they can be shared by many queries
+
+    Args:
+        contigs (list): instances of class Contig
+        k (int): kmer size
+
+    Returns:
+        dict: kmer codes (keys) and list of touples of the contig number (position in contigs) and start position in the contig (values)
+    """
+    contig_index = {}
+    for contig_number, contig in enumerate(contigs):
+        for contig_start, code in encode_kmers(contig.sequence, k):
+            if code in contig_index:
+                contig_index[code].append((contig_number, contig_start))
+            else:
+                contig_index[code] = [(contig_number, contig_start)]
+    return contig_index
+
+
+def find_contig_seeds(contig_index, query_seq, k, num_contigs):
+    """
+    find all exact kmer matches between the query and every indexed contig
+
+    Only the query kmers are looked up, so the contigs are not scanned again for each query.
+
+    Args:
+        contig_index (dict): contig kmers made by index_contig_kmers
+        query_seq (str): sequence to align against
+        k (int): kmer size
+        num_contigs (int): number of indexed contigs
+
+    Returns:
+        list: seeds of each contig in the same order as find_seeds, in the order of the contigs
+    """
+    all_seeds = [[] for _ in range(num_contigs)]
+    for query_start, code in encode_kmers(query_seq, k):
+        for contig_number, contig_start in contig_index.get(code, ()):
+            all_seeds[contig_number].append((query_start, contig_start))
+    for seeds in all_seeds:
+        seeds.sort(key=lambda seed: (seed[1], seed[0]))
+    return all_seeds
+
+
+def find_all_seeds(query_seq, contigs, k, contig_index=None):
+    """
+    find the seeds of every contig, from the contig index if given or by scanning the contigs
+
+    Args:
+        query_seq (str): sequence to align against
+        contigs (list): instances of class Contig
+        k (int): kmer size
+        contig_index (dict): kmers of the contigs made by index_contig_kmers
+
+    Returns:
+        list: seeds of each contig, in the order of the contigs
+    """
+    if contig_index is None:
+        query_index = index_query_kmers(query_seq, k)
+        return [find_seeds(query_index, contig.sequence, k) for contig in contigs]
+    return find_contig_seeds(contig_index, query_seq, k, len(contigs))
+
+
+def reverse_seeds(seeds, query_length, sequence_length, k):
+    """
+    convert seeds of the reverse complement of the query against a contig into seeds of
+    the query against the reverse complement of the contig
+
+    Args:
+        seeds (list): touples of the start position in the reversed query and in the contig
+        query_length (int): length of the query sequence
+        sequence_length (int): length of the contig
+        k (int): kmer size
+
+    Returns:
+        list: touples of the start position in the query and in the reversed contig, in the same order as find_seeds
+    """
+    reversed_seeds = [
+        (query_length - k - query_start, sequence_length - k - contig_start)
+        for query_start, contig_start in seeds
+    ]
+    reversed_seeds.sort(key=lambda seed: (seed[1], seed[0]))
+    return reversed_seeds
+
+
+def oriented_sequence(contig):
+    """
+    get the sequence of a contig on the strand it aligns to the query
+
+    Args:
+        contig (Contig): contig with direction 1 for its own strand or -1 for the reverse complement
+
+    Returns:
+        str: sequence of the contig, reverse complemented if its direction is -1
+    """
+    if contig.direction == -1:
+        return reverse_complement(contig.sequence)
+    return contig.sequence
+
+
+def get_contigs_to_align(query_seq, contigs, k, contig_index=None, canonical=False):
     """
     find all contigs that have a kmer match to the query sequence
 
+    The seeds (matching kmer positions) found for each contig are stored on the contig.
+    In canonical mode contigs may have been assembled from either strand, so the reverse
+    complement of the query is seeded too, and each contig is turned to the strand with
+    the most seeds (its direction is set to 1 or -1, see oriented_sequence).
+
     Args:
         query_seq (str): sequence to align against
         contigs (list): instances of class Contigs containing all assemble reads
         k (int): kmer size
+        contig_index (dict): kmers of the contigs made by index_contig_kmers, if None the contigs are scanned
+        canonical (bool): whether contigs can be on the other strand than the query
 
     Raises:
-        Exception: no kmer matches between reads and query
+        NoAlignmentError: no kmer matches between reads and query
 
     Returns:
-        touple : list of instances of class Contig that contain a kmer match, list of class Contigs that do not share a kmer match
+        list : instances of class Contig that contain a kmer match
     """
-    query_kmers = create_query_kmers(query_seq, k)
-    contig_kmers = create_contig_kmers(contigs, k)
-    kmer_match = []
+    all_seeds = find_all_seeds(query_seq, contigs, k, contig_index)
+    if canonical:
+        all_reverse_seeds = find_all_seeds(
+            reverse_complement(query_seq), contigs, k, contig_index
+        )
+        for index, (contig, reverse) in enumerate(zip(contigs, all_reverse_seeds)):
+            contig.direction = 1
+            if len(reverse) > len(all_seeds[index]):
+                contig.direction = -1
+                all_seeds[index] = reverse_seeds(
+                    reverse, len(query_seq), len(contig.sequence), k
+                )
     contigs_to_align = []
-    for contig_kmer in contig_kmers:
-        for query_kmer in query_kmers:
-            if contig_kmer.sequence == query_kmer.sequence:
-                contig_id = contig_kmer.read_id
-                if contig_id not in kmer_match:
-                    kmer_match.append(contig_id)
-                break
-
-    for contig in contigs:
-        if contig.contig_id in kmer_match:
+    num_seeds = 0
+    for contig, seeds in zip(contigs, all_seeds):
+        contig.add_seeds(seeds)
+        if seeds:
             contigs_to_align.append(contig)
+            num_seeds += len(seeds)
     if len(contigs_to_align) == 0:
-        raise Exception("No contigs align to query sequence")
+        raise NoAlignmentError("No contigs align to query sequence")
     print(
-        f"{datetime.datetime.now()}: found {len(contigs_to_align)} contigs for alignment"
+        f"{datetime.datetime.now()}: found {len(contigs_to_align)} contigs for alignment with {num_seeds} seeds"
     )
     return contigs_to_align
 
@@ -70,11 +243,9 @@ def score_matches(base1, base2, match_score, mismatch_score):
         return mismatch_score
 
 
-def compare_sequences(
-    query, sequence, match_score, gap_score, mismatch_score, threshold
-):
+def fill_score_matrix(query, sequence, match_score, gap_score, mismatch_score):
     """
-    generate an alignmnet score between two sequences
+    fill the local alignment score matrix one cell at a time
 
     Args:
         query (str): query sequence to align against
@@ -82,14 +253,11 @@ def compare_sequences(
         match_score (int): score for matching bases
         gap_score (int): penalty for introducing a gap
         mismatch_score (int): penalty for a mismatch
-        threshold (float): minimum score to be considered an alignmnet (between 0-1)
 
     Returns:
-        float: alignment score
-        bool: whether alignmnet was above the threshold
+        numpy.ndarray: score matrix with query positions as rows and sequence positions as columns
     """
     scores = np.zeros((len(query) + 1, len(sequence) + 1))
-    best_score = 0
     for row in range(1, len(query) + 1):
         for col in range(1, len(sequence) + 1):
             max_score = max(
@@ -102,68 +270,1367 @@ def compare_sequences(
                 scores[row][col - 1] + gap_score,
             )
             scores[row][col] = max_score
-            if scores[row][col] >= best_score:
-                best_score = scores[row][col]
-    if len(sequence) < len(query):
-        score = best_score / len(sequence)
-    else:
-        score = best_score / len(query)
-    if score < threshold:
-        score = None
-        alignment = False
-        return score, alignment
-    else:
-        alignment = True
-        return score, alignment
+    return scores
 
 
-def alignment(
-    query_seq,
-    contigs,
-    k,
-    match_score,
-    gap_score,
-    mismatch_score,
-    threshold,
-    save,
-    out_dir,
+def fill_score_matrix_numpy(query, sequence, match_score, gap_score, mismatch_score):
+    """
+    fill the local alignment score matrix one row at a time with numpy
+
+    Diagonal and vertical moves only depend on the previous row, so they are computed for the
+    whole row at once. Horizontal gaps are then added with a running maximum along the row.
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        numpy.ndarray: score matrix with query positions as rows and sequence positions as columns
+    """
+    bases = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    # score of each query base against every base of the sequence
+    profile = {
+        base: np.where(bases == ord(base), match_score, mismatch_score)
+        for base in set(query)
+    }
+    gaps = np.arange(len(sequence) + 1) * gap_score
+    scores = np.zeros((len(query) + 1, len(sequence) + 1))
+    for row in range(1, len(query) + 1):
+        previous = scores[row - 1]
+        current = scores[row]
+        current[1:] = np.maximum(
+            previous[:-1] + profile[query[row - 1]], previous[1:] + gap_score
+        )
+        np.maximum(current, 0, out=current)
+        # best score ending in a horizontal gap: max over l <= col of current[l] + (col - l) * gap
+        current[:] = np.maximum.accumulate(current - gaps) + gaps
+    return scores
+
+
+def score_dtype(query_length, sequence_length, match_score, gap_score, mismatch_score):
+    """
+    choose the smallest numpy dtype that can hold every value computed while scoring
+
+    Args:
+        query_length (int): length of the query sequence
+        sequence_length (int): length of the contig
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        numpy.dtype: integer dtype for integer scores, otherwise float64
+    """
+    values = [match_score, gap_score, mismatch_score]
+    if not all(float(value).is_integer() for value in values):
+        return np.dtype(np.float64)
+    # no score or shifted gap score can move further from zero than this
+    bound = (
+        2 * max(abs(value) for value in values) * (query_length + sequence_length + 1)
+    )
+    for dtype in [np.int16, np.int32]:
+        if bound < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def best_local_score(
+    query, sequence, match_score, gap_score, mismatch_score, min_score=None
 ):
     """
-    align all contigs against the query
+    find the best local alignment score keeping only two rows of the score matrix
 
     Args:
-        query_seq (str): query sequence to align against
-        contigs (list): instances of class Contig containing all assembled contigs
+        query (str): query sequence to align against
+        sequence (str): contig to align
         match_score (int): score for matching bases
         gap_score (int): penalty for introducing a gap
         mismatch_score (int): penalty for a mismatch
-        threshold (float): minimum score to be considered an alignmnet (between 0-1)
-        save (bool): whether to save csv of all alignment scores (for true alignments)
+        min_score (float): if given, stop once the best score can no longer reach it
 
-    Raises:
-        Exception: if no contigs are above the specified alignment score threshold
+    Returns:
+        int: best score in the score matrix, or None if the alignment was stopped early
+    """
+    best_score = 0
+    previous = [0] * (len(sequence) + 1)
+    for row in range(1, len(query) + 1):
+        current = [0] * (len(sequence) + 1)
+        for col in range(1, len(sequence) + 1):
+            current[col] = max(
+                0,
+                previous[col - 1]
+                + score_matches(
+                    query[row - 1], sequence[col - 1], match_score, mismatch_score
+                ),
+                previous[col] + gap_score,
+                current[col - 1] + gap_score,
+            )
+        best_score = max(best_score, max(current))
+        if cannot_reach(
+            best_score, max(current), len(query) - row, match_score, min_score
+        ):
+            return None
+        previous = current
+    return best_score
+
+
+def best_local_score_numpy(
+    query, sequence, match_score, gap_score, mismatch_score, min_score=None
+):
+    """
+    find the best local alignment score with numpy keeping only two rows of the score matrix
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        min_score (float): if given, stop once the best score can no longer reach it
 
     Returns:
-        list: all instances of class Contig that align to the query
+        int: best score in the score matrix, or None if the alignment was stopped early
     """
-    score_dict = {}
-    aligned_contigs = []
-    contigs_to_align = get_contigs_to_align(query_seq, contigs, k)
-    num_contigs = len(contigs_to_align)
-    for i in range(num_contigs):
-        contig_id = contigs_to_align[i].contig_id
-        sequence = contigs_to_align[i].sequence
-        score, alignment = compare_sequences(
-            query_seq, sequence, match_score, gap_score, mismatch_score, threshold
+    dtype = score_dtype(
+        len(query), len(sequence), match_score, gap_score, mismatch_score
+    )
+    bases = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    profile = {
+        base: np.where(bases == ord(base), match_score, mismatch_score).astype(dtype)
+        for base in set(query)
+    }
+    gaps = np.arange(len(sequence) + 1, dtype=dtype) * dtype.type(gap_score)
+    previous = np.zeros(len(sequence) + 1, dtype=dtype)
+    current = np.zeros(len(sequence) + 1, dtype=dtype)
+    best_score = 0
+    for row in range(1, len(query) + 1):
+        np.maximum(
+            previous[:-1] + profile[query[row - 1]],
+            previous[1:] + dtype.type(gap_score),
+            out=current[1:],
         )
-        if alignment:
-            score_dict[contig_id] = score
-            aligned_contigs.append(contigs_to_align[i])
-    if len(aligned_contigs) == 0:
-        raise Exception("No contigs align to query sequence")
-    if save:
-        with open(f"{out_dir}/alignment_scores.csv", "w") as csv_file:
-            writer = csv.writer(csv_file)
-            for key, value in score_dict.items():
-                writer.writerow([key, value])
-    return aligned_contigs
+        np.maximum(current, 0, out=current)
+        current -= gaps
+        np.maximum.accumulate(current, out=current)
+        current += gaps
+        row_max = current.max()
+        best_score = max(best_score, row_max)
+        if cannot_reach(best_score, row_max, len(query) - row, match_score, min_score):
+            return None
+        previous, current = current, previous
+    return best_score
+
+
+def cannot_reach(best_score, row_max, rows_left, match_score, min_score):
+    """
+    check if an alignment can no longer reach the minimum score after filling a row
+
+    An alignment that ends in a later row either passes through this row, with a score
+    of at most the best score in the row, or starts after it. Either way each remaining
+    query base can add at most one match score.
+
+    Args:
+        best_score (int): best score found so far
+        row_max (int): best score in the last row that was filled
+        rows_left (int): number of rows of the matrix that have not been filled
+        match_score (int): score for matching bases
+        min_score (float): minimum score needed made by pruning_score, or None to never stop
+
+    Returns:
+        bool: True if the best score can no longer reach min_score
+    """
+    if min_score is None:
+        return False
+    upper_bound = max(best_score, row_max + max(match_score, 0) * rows_left)
+    return upper_bound < min_score
+
+
+def bounds_hold(match_score, gap_score, mismatch_score):
+    """
+    check that the scoring makes a match the best step, which the pruning bounds rely on
+
+    With a positive gap score or a mismatch scoring above a match, a query base can add
+    more than one match score, so alignments could be pruned that would pass.
+
+    Args:
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        bool: True if alignments can be pruned safely
+    """
+    return (
+        match_score > 0
+        and gap_score < 0
+        and mismatch_score < 0
+        and mismatch_score <= match_score
+    )
+
+
+def pruning_score(
+    query_length, sequence_length, threshold, match_score, gap_score, mismatch_score
+):
+    """
+    compute the best score an alignment needs to pass the threshold
+
+    Args:
+        query_length (int): length of the query sequence
+        sequence_length (int): length of the contig
+        threshold (float): minimum normalized score to be considered an alignmnet
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        float: slightly lowered minimum best score so rounding never prunes a passing alignment,
+            or None if every alignment passes or the scoring does not allow pruning
+    """
+    min_score = threshold * min(query_length, sequence_length)
+    if min_score <= 0 or not bounds_hold(match_score, gap_score, mismatch_score):
+        return None
+    return min_score * (1 - 1e-9)
+
+
+def min_shared_kmers(
+    query_length, sequence_length, k, match_score, gap_score, mismatch_score, threshold
+):
+    """
+    find how many kmer matches an alignment that passes the threshold must contain (q-gram lemma)
+
+    An alignment with M matches and E mismatches or gap columns scores at most
+    M * match - E * penalty, where penalty is the smaller of the mismatch and gap
+    penalties, so E is bounded for a given score. The query part of the alignment is at
+    least M long and each error breaks at most k of its kmers, so at least
+    M - k + 1 - k * E kmers match exactly. This is linear in M, so the smallest bound is
+    found at the fewest (score / match) or most (length of the shorter sequence) matches.
+
+    The bound only holds if every error is penalized and matches score better than
+    mismatches (see bounds_hold), and if both sequences have no N bases (kmers with an N
+    give no matches).
+
+    Args:
+        query_length (int): length of the query sequence
+        sequence_length (int): length of the contig
+        k (int): kmer size
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum normalized score to be considered an alignmnet
+
+    Returns:
+        int: number of kmer matches needed, 0 if no bound can be given
+    """
+    min_score = pruning_score(
+        query_length, sequence_length, threshold, match_score, gap_score, mismatch_score
+    )
+    if min_score is None:
+        return 0
+    penalty = min(-gap_score, -mismatch_score)
+    most_matches = min(query_length, sequence_length)
+    fewest_matches = min_score / match_score
+
+    def shared_kmers(matches):
+        errors = (matches * match_score - min_score) / penalty
+        return matches - k + 1 - k * errors
+
+    bound = min(shared_kmers(fewest_matches), shared_kmers(most_matches))
+    # rounded down so the bound stays safe
+    return max(0, int(np.floor(bound - 1e-9)))
+
+
+def seed_band(seeds, band):
+    """
+    find the band of diagonals around the seeds to extend the alignment in
+
+    Diagonals are numbered by contig position minus query position.
+
+    Args:
+        seeds (list): touples of the start position in the query and start position in the contig of each match
+        band (int): number of diagonals to add on each side of the seeds
+
+    Returns:
+        touple: lowest and highest diagonal of the band, or None if there are no seeds or they are too scattered for a band
+    """
+    if not seeds:
+        return None
+    diagonals = [contig_start - query_start for query_start, contig_start in seeds]
+    low = min(diagonals)
+    high = max(diagonals)
+    # seeds on distant diagonals would need a band as large as the full matrix
+    if high - low > 2 * band:
+        return None
+    return low - band, high + band
+
+
+def banded_local_score(
+    query, sequence, match_score, gap_score, mismatch_score, low, high, min_score=None
+):
+    """
+    find the best local alignment score using only the cells between two diagonals
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        low (int): lowest diagonal (sequence position minus query position) in the band
+        high (int): highest diagonal in the band
+        min_score (float): if given, stop once the best score can no longer reach it
+
+    Returns:
+        int: best score in the band of the score matrix, or None if the alignment was stopped early
+    """
+    outside = float("-inf")
+    best_score = 0
+    previous = {}
+    for row in range(max(1, 1 - high), min(len(query), len(sequence) - low) + 1):
+        current = {}
+        for col in range(max(1, row + low), min(len(sequence), row + high) + 1):
+            # the first row and column are the zero border of the matrix
+            diagonal = previous.get(col - 1, outside) if row > 1 and col > 1 else 0
+            up = previous.get(col, outside) if row > 1 else 0
+            left = current.get(col - 1, outside) if col > 1 else 0
+            current[col] = max(
+                0,
+                diagonal
+                + score_matches(
+                    query[row - 1], sequence[col - 1], match_score, mismatch_score
+                ),
+                up + gap_score,
+                left + gap_score,
+            )
+        row_max = max(current.values(), default=0)
+        best_score = max(best_score, row_max)
+        if cannot_reach(best_score, row_max, len(query) - row, match_score, min_score):
+            return None
+        previous = current
+    return best_score
+
+
+def banded_local_score_numpy(
+    query, sequence, match_score, gap_score, mismatch_score, low, high, min_score=None
+):
+    """
+    find the best local alignment score with numpy using only the cells between two diagonals
+
+    Each row only updates the slice of columns inside the band, so the cost is the
+    number of rows times the band width instead of the size of the matrix.
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        low (int): lowest diagonal (sequence position minus query position) in the band
+        high (int): highest diagonal in the band
+        min_score (float): if given, stop once the best score can no longer reach it
+
+    Returns:
+        int: best score in the band of the score matrix, or None if the alignment was stopped early
+    """
+    dtype = score_dtype(
+        len(query), len(sequence), match_score, gap_score, mismatch_score
+    )
+    if dtype.kind == "f":
+        outside = -np.inf
+    else:
+        # low enough to never win, with room to add scores without overflowing
+        outside = np.iinfo(dtype).min // 2
+    bases = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    profile = {
+        base: np.where(bases == ord(base), match_score, mismatch_score).astype(dtype)
+        for base in set(query)
+    }
+    gaps = np.arange(len(sequence) + 1, dtype=dtype) * dtype.type(gap_score)
+    first_row = max(1, 1 - high)
+    # the row above the band is the zero border of the matrix if the band starts in the
+    # first row, otherwise it is outside the band except for the zero first column
+    previous = np.full(len(sequence) + 2, outside, dtype=dtype)
+    if first_row == 1:
+        previous[:] = 0
+    current = np.full(len(sequence) + 2, outside, dtype=dtype)
+    previous[0] = current[0] = 0
+    best_score = 0
+    for row in range(first_row, min(len(query), len(sequence) - low) + 1):
+        start = max(1, row + low)
+        stop = min(len(sequence), row + high) + 1
+        cells = current[start:stop]
+        np.maximum(
+            previous[start - 1 : stop - 1]
+            + profile[query[row - 1]][start - 1 : stop - 1],
+            previous[start:stop] + dtype.type(gap_score),
+            out=cells,
+        )
+        np.maximum(cells, 0, out=cells)
+        cells -= gaps[start:stop]
+        np.maximum.accumulate(cells, out=cells)
+        cells += gaps[start:stop]
+        # the cell right of the band is read as the up move of the next row, cells
+        # further out are never read
+        current[stop] = outside
+        row_max = cells.max()
+        best_score = max(best_score, row_max)
+        if cannot_reach(best_score, row_max, len(query) - row, match_score, min_score):
+            return None
+        previous, current = current, previous
+    return best_score
+
+
+# engines that can be used to fill the score matrix
+ENGINES = {"python": fill_score_matrix, "numpy": fill_score_matrix_numpy}
+# engines that can be used to find the best score without keeping the score matrix
+SCORE_ENGINES = {"python": best_local_score, "numpy": best_local_score_numpy}
+# engines that can be used to find the best score in a band around the seeds
+BANDED_ENGINES = {"python": banded_local_score, "numpy": banded_local_score_numpy}
+
+
+def compare_sequences(
+    query,
+    sequence,
+    match_score,
+    gap_score,
+    mismatch_score,
+    threshold,
+    engine="python",
+    score_only=False,
+    band=None,
+    seeds=None,
+):
+    """
+    generate an alignmnet score between two sequences
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        engine (str): how to fill the score matrix, one of ENGINES
+        score_only (bool): keep only two rows of the score matrix instead of the full matrix
+        band (int): if given, only extend the alignment this many diagonals around the seeds
+        seeds (list): touples of query and contig start positions of kmer matches, needed for a band
+
+    Returns:
+        float: alignment score
+        bool: whether alignmnet was above the threshold
+    """
+    score, alignment, _ = align_sequences(
+        query,
+        sequence,
+        match_score,
+        gap_score,
+        mismatch_score,
+        threshold,
+        engine,
+        score_only,
+        band,
+        seeds,
+    )
+    return score, alignment
+
+
+def align_sequences(
+    query,
+    sequence,
+    match_score,
+    gap_score,
+    mismatch_score,
+    threshold,
+    engine="python",
+    score_only=False,
+    band=None,
+    seeds=None,
+):
+    """
+    generate an alignmnet score between two sequences like compare_sequences, and report if it was stopped early
+
+    When only the best score is kept, the alignment is stopped as soon as it can no
+    longer reach the threshold.
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        engine (str): how to fill the score matrix, one of ENGINES
+        score_only (bool): keep only two rows of the score matrix instead of the full matrix
+        band (int): if given, only extend the alignment this many diagonals around the seeds
+        seeds (list): touples of query and contig start positions of kmer matches, needed for a band
+
+    Returns:
+        float: alignment score
+        bool: whether alignmnet was above the threshold
+        bool: whether the alignment was stopped early because it could not reach the threshold
+    """
+    min_score = pruning_score(
+        len(query), len(sequence), threshold, match_score, gap_score, mismatch_score
+    )
+    window = seed_band(seeds, band) if band is not None else None
+    if window is not None:
+        best_score = BANDED_ENGINES[engine](
+            query, sequence, match_score, gap_score, mismatch_score, *window, min_score
+        )
+    elif score_only:
+        best_score = SCORE_ENGINES[engine](
+            query, sequence, match_score, gap_score, mismatch_score, min_score
+        )
+    else:
+        scores = ENGINES[engine](
+            query, sequence, match_score, gap_score, mismatch_score
+        )
+        best_score = scores.max()
+    if best_score is None:
+        return None, False, True
+    score, alignment = normalize_score(best_score, len(query), len(sequence), threshold)
+    return score, alignment, False
+
+
+def normalize_score(best_score, query_length, sequence_length, threshold):
+    """
+    divide the best score by the length of the shorter sequence and apply the threshold
+
+    Args:
+        best_score (int): best score in the score matrix
+        query_length (int): length of the query sequence
+        sequence_length (int): length of the contig
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+
+    Returns:
+        float: alignment score
+        bool: whether alignmnet was above the threshold
+    """
+    if sequence_length < query_length:
+        score = best_score / sequence_length
+    else:
+        score = best_score / query_length
+    if score < threshold:
+        score = None
+        alignment = False
+        return score, alignment
+    else:
+        alignment = True
+        return score, alignment
+
+
+def best_local_scores_batch(
+    query, sequences, match_score, gap_score, mismatch_score, min_scores=None
+):
+    """
+    find the best local alignment score of many contigs against the query at once
+
+    The contigs are packed into the rows of a padded array, so each query base updates
+    the score rows of every contig with a single set of numpy operations. Scores in the
+    padding never flow back into a contig, and are left out of its best score.
+    Contigs that can no longer reach their minimum score are removed from the batch.
+
+    Args:
+        query (str): query sequence to align against
+        sequences (list): contigs to align, best of similar lengths to limit padding
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        min_scores (list): if given, minimum score each contig needs (None to never stop)
+
+    Returns:
+        np.array: best score of each contig in the order of sequences
+        np.array: whether each contig was stopped early, its best score is then only partial
+    """
+    lengths = np.array([len(sequence) for sequence in sequences])
+    width = lengths.max()
+    dtype = score_dtype(len(query), width, match_score, gap_score, mismatch_score)
+    bases = np.zeros((len(sequences), width), dtype=np.uint8)
+    for index, sequence in enumerate(sequences):
+        bases[index, : len(sequence)] = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    profile = {
+        base: np.where(bases == ord(base), match_score, mismatch_score).astype(dtype)
+        for base in set(query)
+    }
+    gaps = np.arange(width + 1, dtype=dtype) * dtype.type(gap_score)
+    in_contig = np.arange(width + 1) <= lengths[:, None]
+    previous = np.zeros((len(sequences), width + 1), dtype=dtype)
+    current = np.zeros((len(sequences), width + 1), dtype=dtype)
+    best_scores = np.zeros(len(sequences), dtype=dtype)
+    pruned = np.zeros(len(sequences), dtype=bool)
+    # rows of the batch that are still being aligned
+    active = np.arange(len(sequences))
+    if min_scores is not None:
+        min_scores = np.array(
+            [np.inf if x is None else x for x in min_scores], dtype=np.float64
+        )
+        # contigs that every alignment passes are never stopped
+        min_scores[np.isinf(min_scores)] = -np.inf
+    active_best = best_scores.copy()
+    for row in range(1, len(query) + 1):
+        np.maximum(
+            previous[:, :-1] + profile[query[row - 1]],
+            previous[:, 1:] + dtype.type(gap_score),
+            out=current[:, 1:],
+        )
+        np.maximum(current, 0, out=current)
+        current -= gaps
+        np.maximum.accumulate(current, axis=1, out=current)
+        current += gaps
+        row_max = current.max(axis=1, where=in_contig, initial=0)
+        np.maximum(active_best, row_max, out=active_best)
+        if min_scores is not None:
+            upper_bound = np.maximum(
+                active_best,
+                row_max.astype(np.float64) + max(match_score, 0) * (len(query) - row),
+            )
+            stopped = upper_bound < min_scores[active]
+            if stopped.any():
+                best_scores[active] = active_best
+                pruned[active[stopped]] = True
+                keep = ~stopped
+                active = active[keep]
+                active_best = active_best[keep]
+                previous = previous[keep]
+                current = current[keep]
+                in_contig = in_contig[keep]
+                profile = {base: scores[keep] for base, scores in profile.items()}
+                if len(active) == 0:
+                    break
+        previous, current = current, previous
+    best_scores[active] = active_best
+    return best_scores, pruned
+
+
+def length_batches(sequences, batch_size=256, max_padding=0.25):
+    """
+    group sequences of similar length into batches
+
+    Args:
+        sequences (list): contig sequences
+        batch_size (int): largest number of sequences in a batch
+        max_padding (float): longest sequence in a batch is at most this fraction longer than the shortest
+
+    Returns:
+        list: lists of indices into sequences, one list per batch
+    """
+    order = sorted(range(len(sequences)), key=lambda index: len(sequences[index]))
+    batches = []
+    batch = []
+    for index in order:
+        if batch and (
+            len(batch) == batch_size
+            or len(sequences[index]) > (1 + max_padding) * len(sequences[batch[0]])
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def score_batch(query, sequences, match_score, gap_score, mismatch_score, threshold):
+    """
+    align a batch of contigs against the query with best_local_scores_batch
+
+    Args:
+        query (str): query sequence to align against
+        sequences (list): contigs to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+
+    Returns:
+        list: touples of alignment score, whether the alignment was above the threshold and whether it was stopped early, in the order of sequences
+    """
+    min_scores = [
+        pruning_score(
+            len(query), len(sequence), threshold, match_score, gap_score, mismatch_score
+        )
+        for sequence in sequences
+    ]
+    best_scores, pruned = best_local_scores_batch(
+        query, sequences, match_score, gap_score, mismatch_score, min_scores
+    )
+    results = []
+    for best_score, sequence, stopped in zip(best_scores, sequences, pruned):
+        if stopped:
+            results.append((None, False, True))
+        else:
+            score, alignment = normalize_score(
+                best_score, len(query), len(sequence), threshold
+            )
+            results.append((score, alignment, False))
+    return results
+
+
+# query and scoring parameters set once in each worker process by init_worker
+worker_settings = {}
+
+
+def init_worker(
+    query_seq, match_score, gap_score, mismatch_score, threshold, engine, band=None
+):
+    """
+    store the query and scoring parameters in a worker process
+
+    Args:
+        query_seq (str): query sequence to align against
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        engine (str): how to fill the score matrix, one of ENGINES
+        band (int): number of diagonals around the seeds to extend alignments in (full matrix if None)
+    """
+    worker_settings["query_seq"] = query_seq
+    worker_settings["scores"] = (match_score, gap_score, mismatch_score, threshold)
+    worker_settings["engine"] = engine
+    worker_settings["band"] = band
+
+
+def align_in_worker(sequence, seeds=None):
+    """
+    align a contig against the query stored in the worker process
+
+    Args:
+        sequence (str): contig to align
+        seeds (list): kmer matches between the query and the contig
+
+    Returns:
+        touple: alignment score, whether the alignment was above the threshold and whether it was stopped early
+    """
+    return align_sequences(
+        worker_settings["query_seq"],
+        sequence,
+        *worker_settings["scores"],
+        worker_settings["engine"],
+        score_only=True,
+        band=worker_settings["band"],
+        seeds=seeds,
+    )
+
+
+def align_batch_in_worker(sequences):
+    """
+    align a batch of contigs against the query stored in the worker process
+
+    Args:
+        sequences (list): contigs to align
+
+    Returns:
+        list: touples of alignment score, whether the alignment was above the threshold and whether it was stopped early
+    """
+    return score_batch(
+        worker_settings["query_seq"], sequences, *worker_settings["scores"]
+    )
+
+
+def score_contigs_batched(
+    query_seq,
+    sequences,
+    match_score,
+    gap_score,
+    mismatch_score,
+    threshold,
+    workers=1,
+    band=None,
+    seeds=None,
+):
+    """
+    align contigs in batches of similar length, optionally across several processes
+
+    Contigs that can be aligned in a band around their seeds are aligned one at a time
+    with the numpy banded engine, all others are batched.
+
+    Args:
+        query_seq (str): query sequence to align against
+        sequences (list): contig sequences to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        workers (int): number of processes to use
+        band (int): number of diagonals around the seeds to extend alignments in (full matrix if None)
+        seeds (list): kmer matches of each sequence, in the order of sequences
+
+    Returns:
+        list: touples of alignment score, whether the alignment was above the threshold and whether it was stopped early, in the order of sequences
+    """
+    results = [None] * len(sequences)
+    unbanded = []
+    for index, (sequence, sequence_seeds) in enumerate(zip(sequences, seeds)):
+        if band is not None and seed_band(sequence_seeds, band) is not None:
+            results[index] = align_sequences(
+                query_seq,
+                sequence,
+                match_score,
+                gap_score,
+                mismatch_score,
+                threshold,
+                "numpy",
+                score_only=True,
+                band=band,
+                seeds=sequence_seeds,
+            )
+        else:
+            unbanded.append(index)
+    batches = [
+        [unbanded[index] for index in batch]
+        for batch in length_batches([sequences[index] for index in unbanded])
+    ]
+    batch_sequences = [[sequences[index] for index in batch] for batch in batches]
+    if workers <= 1 or len(batches) <= 1:
+        batch_results = [
+            score_batch(
+                query_seq, batch, match_score, gap_score, mismatch_score, threshold
+            )
+            for batch in batch_sequences
+        ]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(
+                query_seq,
+                match_score,
+                gap_score,
+                mismatch_score,
+                threshold,
+                "batch",
+            ),
+        ) as executor:
+            batch_results = list(executor.map(align_batch_in_worker, batch_sequences))
+    for batch, batch_result in zip(batches, batch_results):
+        for index, result in zip(batch, batch_result):
+            results[index] = result
+    return results
+
+
+def score_contigs(
+    query_seq,
+    sequences,
+    match_score,
+    gap_score,
+    mismatch_score,
+    threshold,
+    engine="python",
+    workers=1,
+    band=None,
+    seeds=None,
+):
+    """
+    align each sequence against the query, optionally across several processes
+
+    Args:
+        query_seq (str): query sequence to align against
+        sequences (list): contig sequences to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        engine (str): how to fill the score matrix, one of ENGINES or "batch" to align contigs of similar length together
+        workers (int): number of processes to use
+        band (int): number of diagonals around the seeds to extend alignments in (full matrix if None)
+        seeds (list): kmer matches of each sequence, in the order of sequences
+
+    Returns:
+        list: touples of alignment score, whether the alignment was above the threshold and whether it was stopped early, in the order of sequences
+    """
+    if seeds is None:
+        seeds = [None] * len(sequences)
+    if engine == "batch":
+        return score_contigs_batched(
+            query_seq,
+            sequences,
+            match_score,
+            gap_score,
+            mismatch_score,
+            threshold,
+            workers,
+            band,
+            seeds,
+        )
+    if workers <= 1 or len(sequences) <= 1:
+        return [
+            align_sequences(
+                query_seq,
+                sequence,
+                match_score,
+                gap_score,
+                mismatch_score,
+                threshold,
+                engine,
+                score_only=True,
+                band=band,
+                seeds=sequence_seeds,
+            )
+            for sequence, sequence_seeds in zip(sequences, seeds)
+        ]
+    # the query is sent to each worker once, and contigs are sent in chunks
+    chunksize = max(1, len(sequences) // (workers * 4))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(
+            query_seq,
+            match_score,
+            gap_score,
+            mismatch_score,
+            threshold,
+            engine,
+            band,
+        ),
+    ) as executor:
+        return list(
+            executor.map(align_in_worker, sequences, seeds, chunksize=chunksize)
+        )
+
+
+def score_rows(query, sequence, match_score, gap_score, mismatch_score, local=True):
+    """
+    yield the rows of the score matrix one at a time, so only one row is kept in memory
+
+    Args:
+        query (str): query sequence, one row per base
+        sequence (str): contig, one column per base
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        local (bool): if True, scores of local alignments (never below 0),
+            otherwise of alignments that start at the first base of both sequences
+
+    Yields:
+        np.array: scores of a row, starting with the row before the first query base
+    """
+    bases = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    profile = {
+        base: np.where(bases == ord(base), match_score, mismatch_score).astype(np.int64)
+        for base in set(query)
+    }
+    gaps = np.arange(len(sequence) + 1, dtype=np.int64) * gap_score
+    current = np.zeros(len(sequence) + 1, dtype=np.int64) if local else gaps.copy()
+    yield current
+    for row in range(1, len(query) + 1):
+        previous = current
+        current = np.empty_like(previous)
+        current[0] = 0 if local else row * gap_score
+        current[1:] = np.maximum(
+            previous[:-1] + profile[query[row - 1]], previous[1:] + gap_score
+        )
+        if local:
+            np.maximum(current, 0, out=current)
+        current = np.maximum.accumulate(current - gaps) + gaps
+        yield current
+
+
+def best_cell(query, sequence, match_score, gap_score, mismatch_score, local=True):
+    """
+    find the best score in the score matrix and the first cell that holds it
+
+    Args:
+        query (str): query sequence
+        sequence (str): contig
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        local (bool): score local alignments, otherwise alignments that start at the first base of both sequences
+
+    Returns:
+        touple: best score, and the number of query and contig bases before the cell
+    """
+    best = (None, 0, 0)
+    for row, scores in enumerate(
+        score_rows(query, sequence, match_score, gap_score, mismatch_score, local)
+    ):
+        col = int(scores.argmax())
+        if best[0] is None or scores[col] > best[0]:
+            best = (int(scores[col]), row, col)
+    return best
+
+
+def global_traceback(query, sequence, match_score, gap_score, mismatch_score):
+    """
+    find the operations of the best global alignment from the full score matrix
+
+    Only used on small matrices, where one sequence has at most one base.
+
+    Args:
+        query (str): query sequence
+        sequence (str): contig
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        list: operations along the alignment, "=" match, "X" mismatch,
+            "D" query base missing from the contig and "I" contig base missing from the query
+    """
+    scores = list(
+        score_rows(query, sequence, match_score, gap_score, mismatch_score, False)
+    )
+    operations = []
+    row, col = len(query), len(sequence)
+    while row > 0 or col > 0:
+        if row > 0 and col > 0:
+            diagonal = scores[row - 1][col - 1] + score_matches(
+                query[row - 1], sequence[col - 1], match_score, mismatch_score
+            )
+            if scores[row][col] == diagonal:
+                operations.append("=" if query[row - 1] == sequence[col - 1] else "X")
+                row -= 1
+                col -= 1
+                continue
+        if row > 0 and scores[row][col] == scores[row - 1][col] + gap_score:
+            operations.append("D")
+            row -= 1
+        else:
+            operations.append("I")
+            col -= 1
+    operations.reverse()
+    return operations
+
+
+def hirschberg(query, sequence, match_score, gap_score, mismatch_score):
+    """
+    find the operations of the best global alignment in linear space (Hirschberg)
+
+    The query is split in half, and the contig is split where the scores of aligning the
+    first half forwards and the second half backwards add up to the best total. Each half
+    is then aligned on its own, so only a few rows of scores are kept at any time.
+
+    Args:
+        query (str): query sequence
+        sequence (str): contig
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        list: operations along the alignment, as returned by global_traceback
+    """
+    if len(query) <= 1 or len(sequence) <= 1:
+        return global_traceback(query, sequence, match_score, gap_score, mismatch_score)
+    middle = len(query) // 2
+    for forward in score_rows(
+        query[:middle], sequence, match_score, gap_score, mismatch_score, False
+    ):
+        pass
+    for backward in score_rows(
+        query[middle:][::-1],
+        sequence[::-1],
+        match_score,
+        gap_score,
+        mismatch_score,
+        False,
+    ):
+        pass
+    split = int((forward + backward[::-1]).argmax())
+    return hirschberg(
+        query[:middle], sequence[:split], match_score, gap_score, mismatch_score
+    ) + hirschberg(
+        query[middle:], sequence[split:], match_score, gap_score, mismatch_score
+    )
+
+
+def cigar_string(operations):
+    """
+    join runs of the same alignment operation into a CIGAR string
+
+    Args:
+        operations (list): alignment operations
+
+    Returns:
+        str: CIGAR string, for example "5=1X2=1D3="
+    """
+    cigar = []
+    count = 0
+    for index, operation in enumerate(operations):
+        count += 1
+        if index + 1 == len(operations) or operations[index + 1] != operation:
+            cigar.append(f"{count}{operation}")
+            count = 0
+    return "".join(cigar)
+
+
+def trace_alignment(query, sequence, match_score, gap_score, mismatch_score):
+    """
+    find where the best local alignment lies and how the contig aligns to the query
+
+    The end of the alignment is the best cell of the local score matrix. Its start is the
+    best cell when scoring backwards from the end, and the path in between is recovered
+    with hirschberg, so memory grows with the sequence lengths rather than the matrix.
+
+    Args:
+        query (str): query sequence to align against
+        sequence (str): contig to align
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+
+    Returns:
+        touple: query start, query end, contig start, contig end (0-based, end excluded) and CIGAR string
+    """
+    best_score, query_end, contig_end = best_cell(
+        query, sequence, match_score, gap_score, mismatch_score
+    )
+    if best_score <= 0:
+        return 0, 0, 0, 0, ""
+    _, query_length, contig_length = best_cell(
+        query[:query_end][::-1],
+        sequence[:contig_end][::-1],
+        match_score,
+        gap_score,
+        mismatch_score,
+        local=False,
+    )
+    query_start = query_end - query_length
+    contig_start = contig_end - contig_length
+    operations = hirschberg(
+        query[query_start:query_end],
+        sequence[contig_start:contig_end],
+        match_score,
+        gap_score,
+        mismatch_score,
+    )
+    return query_start, query_end, contig_start, contig_end, cigar_string(operations)
+
+
+def alignment(
+    query_seq,
+    contigs,
+    k,
+    match_score,
+    gap_score,
+    mismatch_score,
+    threshold,
+    save,
+    out_dir,
+    engine="python",
+    workers=1,
+    band=None,
+    traceback=False,
+    contig_index=None,
+    canonical=False,
+):
+    """
+    align all contigs against the query
+
+    Contigs with fewer kmer matches than min_shared_kmers are skipped, and alignments
+    that can no longer reach the threshold are stopped early, neither changes the result.
+
+    Args:
+        query_seq (str): query sequence to align against
+        contigs (list): instances of class Contig containing all assembled contigs
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        save (bool): whether to save csv of all alignment scores (for true alignments)
+        out_dir (str): directory to save the alignment scores
+        engine (str): how to fill the score matrix, one of ENGINES or "batch"
+        workers (int): number of processes to align contigs with
+        band (int): if given, extend alignments this many diagonals around the seeds, contigs
+            with scattered seeds are still aligned over the full matrix
+        traceback (bool): if True, find the coordinates and CIGAR string of each alignment
+            and save them with the alignment scores
+        contig_index (dict): kmers of the contigs made by index_contig_kmers, to reuse across queries
+        canonical (bool): whether contigs can be on the other strand than the query, each
+            contig is then aligned on the strand with the most seeds
+
+    Raises:
+        NoAlignmentError: if no contigs are above the specified alignment score threshold
+
+    Returns:
+        list: all instances of class Contig that align to the query
+    """
+    score_dict = {}
+    aligned_contigs = []
+    contigs_to_align = get_contigs_to_align(
+        query_seq, contigs, k, contig_index, canonical
+    )
+    # contigs with too few kmer matches cannot pass the threshold and are not aligned,
+    # unless an N base hides kmer matches that the alignment still scores
+    num_candidates = len(contigs_to_align)
+    query_has_n = "N" in query_seq
+    contigs_to_align = [
+        contig
+        for contig in contigs_to_align
+        if query_has_n
+        or "N" in contig.sequence
+        or len(contig.seeds)
+        >= min_shared_kmers(
+            len(query_seq),
+            len(contig.sequence),
+            k,
+            match_score,
+            gap_score,
+            mismatch_score,
+            threshold,
+        )
+    ]
+    num_filtered = num_candidates - len(contigs_to_align)
+    if band is not None:
+        num_banded = sum(
+            seed_band(contig.seeds, band) is not None for contig in contigs_to_align
+        )
+        print(
+            f"{datetime.datetime.now()}: aligning {num_banded} contigs in a band and {len(contigs_to_align) - num_banded} over the full matrix"
+        )
+    results = score_contigs(
+        query_seq,
+        [oriented_sequence(contig) for contig in contigs_to_align],
+        match_score,
+        gap_score,
+        mismatch_score,
+        threshold,
+        engine,
+        workers,
+        band,
+        [contig.seeds for contig in contigs_to_align],
+    )
+    num_pruned = sum(pruned for _, _, pruned in results)
+    print(
+        f"{datetime.datetime.now()}: pruned {num_filtered} contigs with the shared kmer filter and {num_pruned} alignments with the score bound"
+    )
+    for contig, (score, alignment, _) in zip(contigs_to_align, results):
+        if alignment:
+            score_dict[contig.contig_id] = score
+            aligned_contigs.append(contig)
+    if len(aligned_contigs) == 0:
+        raise NoAlignmentError("No contigs align to query sequence")
+    # only contigs that pass the threshold are traced back
+    trace_dict = {}
+    if traceback:
+        for contig in aligned_contigs:
+            trace_dict[contig.contig_id] = trace_alignment(
+                query_seq,
+                oriented_sequence(contig),
+                match_score,
+                gap_score,
+                mismatch_score,
+            )
+            if canonical:
+                # contig positions are on the strand the contig was aligned on
+                trace_dict[contig.contig_id] += (contig.direction,)
+        print(f"{datetime.datetime.now()}: traced back {len(trace_dict)} alignments")
+    if save or traceback:
+        with open(f"{out_dir}/alignment_scores.csv", "w") as csv_file:
+            writer = csv.writer(csv_file)
+            for key, value in score_dict.items():
+                writer.writerow([key, value, *trace_dict.get(key, ())])
+    return aligned_contigs
+
+
+def query_directories(out_dir, query_ids):
+    """
+    make an output directory for each query, named after its id
+
+    Characters that are not safe in a file name are replaced with "_". Ids that end up
+    with the same name as another query or as a file in OUTPUT_FILES (ignoring case) get
+    a numbered suffix, so no query overwrites another's outputs or those of the run.
+
+    Args:
+        out_dir (str): directory to store the outputs of all queries
+        query_ids (list): ids of the queries
+
+    Raises:
+        Exception: if an id would name the output directory itself or its parent
+
+    Returns:
+        dict: query ids (keys) and paths to their output directories (values)
+    """
+    query_dirs = {}
+    used_names = {file_name.lower() for file_name in OUTPUT_FILES}
+    for query_id in query_ids:
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", query_id)
+        if name in ("", ".", ".."):
+            raise Exception(f"Query id '{query_id}' cannot be used as a directory name")
+        unique_name = name
+        suffix = 2
+        while unique_name.lower() in used_names:
+            unique_name = f"{name}_{suffix}"
+            suffix += 1
+        used_names.add(unique_name.lower())
+        query_dirs[query_id] = os.path.join(out_dir, unique_name)
+    for query_dir in query_dirs.values():
+        os.makedirs(query_dir, exist_ok=True)
+    return query_dirs
+
+
+def align_queries(
+    query_dict,
+    contigs,
+    k,
+    match_score,
+    gap_score,
+    mismatch_score,
+    threshold,
+    save,
+    out_dir,
+    engine="python",
+    workers=1,
+    band=None,
+    traceback=False,
+    canonical=False,
+):
+    """
+    align the same contigs against each of several queries
+
+    The contig kmers are indexed once and shared by all queries. Outputs of each query
+    are saved in its own directory made by query_directories.
+
+    Args:
+        query_dict (dict): query ids (keys) and sequences (values)
+        contigs (list): instances of class Contig containing all assembled contigs
+        k (int): kmer size
+        match_score (int): score for matching bases
+        gap_score (int): penalty for introducing a gap
+        mismatch_score (int): penalty for a mismatch
+        threshold (float): minimum score to be considered an alignmnet (between 0-1)
+        save (bool): whether to save csv of all alignment scores (for true alignments)
+        out_dir (str): directory to store the outputs of all queries
+        engine (str): how to fill the score matrix, one of ENGINES or "batch"
+        workers (int): number of processes to align contigs with
+        band (int): if given, extend alignments this many diagonals around the seeds
+        traceback (bool): if True, find the coordinates and CIGAR string of each alignment
+        canonical (bool): whether contigs can be on the other strand than the queries
+
+    Returns:
+        dict: query ids (keys) and touples of the output directory and the aligned contigs, empty if none align (values)
+    """
+    contig_index = index_contig_kmers(contigs, k)
+    print(f"{datetime.datetime.now()}: indexed {len(contig_index)} contig kmers")
+    query_dirs = query_directories(out_dir, query_dict)
+    query_results = {}
+    for query_id, query_seq in query_dict.items():
+        query_dir = query_dirs[query_id]
+        print(f"{datetime.datetime.now()}: aligning query {query_id}")
+        try:
+            aligned_contigs = alignment(
+                query_seq,
+                contigs,
+                k,
+                match_score,
+                gap_score,
+                mismatch_score,
+                threshold,
+                save,
+                query_dir,
+                engine,
+                workers,
+                band,
+                traceback,
+                contig_index,
+                canonical,
+            )
+        except NoAlignmentError:
+            # a query without aligned contigs does not stop the other queries
+            print(f"{datetime.datetime.now()}: no contigs align to query {query_id}")
+            aligned_contigs = []
+        query_results[query_id] = (query_dir, aligned_contigs)
+    return query_results
@@ -5,21 +5,44 @@ __date__ = "2023/03/06"
 Functions needed to assemble sequence reads 
 """
 
+from src.kmers import (
+    KmerTable,
+    collect_kmers,
+    decode_kmer,
+    encode_kmer,
+    index_kmers,
+)
+
 
 class Contig:
     """
     holds information about assembled contigs
     """
 
+    __slots__ = (
+        "contig_id",
+        "sequence",
+        "direction",
+        "aligned_reads",
+        "kmers",
+        "seeds",
+    )
+
     def __init__(self, contig_id, aligned_reads, sequence, direction):
         self.contig_id = contig_id
         self.sequence = sequence
         self.direction = direction
         self.aligned_reads = aligned_reads
+        # filled in later by add_kmers and add_seeds
+        self.kmers = None
+        self.seeds = None
 
     def add_kmers(self, kmers):
         self.kmers = kmers
 
+    def add_seeds(self, seeds):
+        self.seeds = seeds
+
 
 def get_contig_kmers(all_paths, read_kmers):
     """
@@ -27,23 +50,25 @@ def get_contig_kmers(all_paths, read_kmers):
 
     Args:
         all_paths (list): instances of class Path that represent all possible paths through the graph
-        read_kmers (list): instances of class Kmer that make up all reads
+        read_kmers (list, dict or KmerTable): instances of class Kmer that make up all reads, an index of them made by index_kmers, or a KmerTable
 
     Returns:
         dict: contig ids (keys) and ids of all kmers that make up contig (values)"""
+    if isinstance(read_kmers, (dict, KmerTable)):
+        # a table looks up kmers by code with the same get method as an index
+        kmer_index = read_kmers
+    else:
+        kmer_index = index_kmers(read_kmers)
     contig_kmers = {}
     for path in all_paths:
         contig_id = path.contig_id
         node_kmers = {}
         for node in path.path:
-            kmers = []
-            for kmer in read_kmers:
-                if kmer.sequence == node:
-                    kmers.append(kmer)
-            kmers.sort(key=lambda x: x.id)
-            node_kmers[node] = kmers
+            # paths through graphs built from an adjacency matrix hold sequences instead of codes
+            code = encode_kmer(node) if isinstance(node, str) else node
+            node_kmers[node] = kmer_index.get(code, [])
         if contig_id in contig_kmers.keys():
-            contig_kmers[contig_id].append(node_kmers)
+            contig_kmers[contig_id].update(node_kmers)
         else:
             contig_kmers[contig_id] = node_kmers
     return contig_kmers
@@ -56,6 +81,9 @@ def assemble_contigs(contig_kmers):
         sequence = str()
         contig_position = 0
         for node, kmers in node_dict.items():
+            if kmers and not isinstance(node, str):
+                # the node code gives the orientation, canonical kmers may be on the other strand
+                node = decode_kmer(node, kmers[0].k)
             for kmer in kmers:
                 read_id = kmer.read_id
                 if read_id not in reads.keys():
@@ -91,11 +119,20 @@ def assembly(paths, read_kmers):
 
     Args:
         paths (list): instances of class Path that represent all possible paths through the graph
-        read_kmers (list): instances of class Kmer that make up all reads
+        read_kmers (KmerTable, list or iterable): kmers that make up all reads, or batches of them as instances of class KmerTable
 
     Returns:
         list: instances of class Contigs
     """
-    contig_kmers = get_contig_kmers(paths, read_kmers)
+    if isinstance(read_kmers, KmerTable):
+        kmer_index = read_kmers
+    elif not isinstance(read_kmers, list):
+        # only the kmers on a path are kept from the batches
+        paths = list(paths)
+        codes = {node for path in paths for node in path.path if isinstance(node, int)}
+        kmer_index = collect_kmers(read_kmers, codes)
+    else:
+        kmer_index = index_kmers(read_kmers)
+    contig_kmers = get_contig_kmers(paths, kmer_index)
     contigs = assemble_contigs(contig_kmers)
     return contigs
@@ -0,0 +1,330 @@
+__author__ = "Keenan Manpearl"
+__date__ = "2023/03/06"
+
+"""
+Functions needed to cache the outputs of pipeline stages on disk
+"""
+
+import datetime
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from src.assembly import Contig
+from src.graph import Paths
+
+# suffix of the files the stage outputs are stored in
+CACHE_SUFFIX = ".npz"
+# changed when the stored arrays change, so old entries are never read
+CACHE_VERSION = 1
+
+
+def file_digest(fp, chunk_size=1 << 20):
+    """
+    hash the contents of a file, so a cache entry is only reused for the same reads
+
+    Args:
+        fp (str): path to the file
+        chunk_size (int): number of bytes to read at once
+
+    Returns:
+        str: hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(fp, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_key(stage, *inputs):
+    """
+    hash the inputs of a stage into the name of its cache entry
+
+    Args:
+        stage (str): name of the stage
+        inputs: values that change the output of the stage
+
+    Returns:
+        str: cache key
+    """
+    digest = hashlib.sha256(repr((CACHE_VERSION, stage) + inputs).encode()).hexdigest()
+    return f"{stage}-{digest}"
+
+
+class StageCache:
+    """
+    stores the outputs of pipeline stages as compressed numpy arrays in a directory
+
+    Each entry is named after its stage and a hash of every input of the stage. When the
+    directory grows beyond max_bytes the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def load(self, key):
+        """
+        read the arrays of a cache entry and mark it as recently used
+
+        Args:
+            key (str): cache key made by stage_key
+
+        Returns:
+            dict: array names (keys) and arrays (values), or None if there is no usable entry
+        """
+        fp = self.path(key)
+        try:
+            with np.load(fp, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # an unreadable entry is dropped and the stage is run again
+            os.remove(fp)
+            return None
+        os.utime(fp)
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        store the arrays of a stage, then evict old entries if the cache is too large
+
+        The entry is written to a temporary file first, so a partly written entry is never read.
+
+        Args:
+            key (str): cache key made by stage_key
+            arrays (dict): array names (keys) and arrays (values)
+        """
+        fp = self.path(key)
+        tmp_fp = f"{fp}.{os.getpid()}.tmp"
+        with open(tmp_fp, "wb") as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(tmp_fp, fp)
+        self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache fits in max_bytes
+
+        Returns:
+            int: number of entries removed
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, name in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total_bytes -= size
+            removed += 1
+        if removed:
+            print(
+                f"{datetime.datetime.now()}: removed {removed} least recently used cache entries"
+            )
+        return removed
+
+
+def code_array(codes):
+    """
+    pack kmer codes into an unsigned 64 bit array
+
+    Args:
+        codes (list or np.array): kmer codes
+
+    Returns:
+        np.array: codes as uint64, or None if a code does not fit (kmers longer than 32 bases)
+    """
+    if isinstance(codes, np.ndarray) and codes.dtype == np.uint64:
+        return codes
+    if len(codes) and max(codes) >= 1 << 64:
+        return None
+    return np.array(codes, dtype=np.uint64)
+
+
+def counts_to_arrays(kmer_counts):
+    """
+    convert the output of count_kmers into arrays for the cache
+
+    Args:
+        kmer_counts (touple): sorted array of distinct kmer codes and array of their counts
+
+    Returns:
+        dict: arrays to cache, or None if the codes cannot be cached
+    """
+    codes, counts = kmer_counts
+    codes = code_array(codes)
+    if codes is None:
+        return None
+    return {"codes": codes, "counts": counts}
+
+
+def arrays_to_counts(arrays):
+    return arrays["codes"], arrays["counts"]
+
+
+def paths_to_arrays(paths):
+    """
+    convert paths through the graph into arrays for the cache
+
+    The nodes of all paths are stored in one array, with the length of each path.
+
+    Args:
+        paths (list): instances of class Paths whose nodes are kmer codes
+
+    Returns:
+        dict: arrays to cache, or None if the nodes cannot be cached
+    """
+    nodes = [node for path in paths for node in path.path]
+    ends = [node for path in paths for node in (path.start_node, path.stop_node)]
+    if any(not isinstance(node, int) for node in nodes + ends):
+        return None
+    nodes = code_array(nodes)
+    ends = code_array(ends)
+    if nodes is None or ends is None:
+        return None
+    return {
+        "contig_id": np.array([path.contig_id for path in paths], dtype=np.int64),
+        "ends": ends,
+        "path_length": np.array([len(path.path) for path in paths], dtype=np.int64),
+        "nodes": nodes,
+    }
+
+
+def arrays_to_paths(arrays):
+    """
+    rebuild paths through the graph from cached arrays
+
+    Args:
+        arrays (dict): arrays made by paths_to_arrays
+
+    Returns:
+        list: instances of class Paths
+    """
+    ends = arrays["ends"].tolist()
+    nodes = arrays["nodes"].tolist()
+    paths = []
+    start = 0
+    for index, (contig_id, path_length) in enumerate(
+        zip(arrays["contig_id"].tolist(), arrays["path_length"].tolist())
+    ):
+        path = nodes[start : start + path_length]
+        start += path_length
+        paths.append(Paths(contig_id, ends[2 * index], ends[2 * index + 1], path))
+    return paths
+
+
+def contigs_to_arrays(contigs):
+    """
+    convert assembled contigs and the positions of their reads into arrays for the cache
+
+    Args:
+        contigs (list): instances of class Contig
+
+    Returns:
+        dict: arrays to cache
+    """
+    read_fields = ["sstart", "send", "qstart", "qend"]
+    read_contig = []
+    read_id = []
+    read_positions = []
+    for contig_number, contig in enumerate(contigs):
+        for read in contig.aligned_reads.values():
+            read_contig.append(contig_number)
+            read_id.append(read["sseqid"])
+            read_positions.append([read[field] for field in read_fields])
+    return {
+        "contig_id": np.array([contig.contig_id for contig in contigs], dtype=np.int64),
+        "direction": np.array([contig.direction for contig in contigs], dtype=np.int64),
+        "sequence_length": np.array(
+            [len(contig.sequence) for contig in contigs], dtype=np.int64
+        ),
+        "sequences": np.frombuffer(
+            "".join(contig.sequence for contig in contigs).encode(), dtype=np.uint8
+        ),
+        "read_contig": np.array(read_contig, dtype=np.int64),
+        "read_id": np.array(read_id, dtype=str),
+        "read_positions": np.array(read_positions, dtype=np.int64).reshape(-1, 4),
+    }
+
+
+def arrays_to_contigs(arrays):
+    """
+    rebuild assembled contigs from cached arrays
+
+    Args:
+        arrays (dict): arrays made by contigs_to_arrays
+
+    Returns:
+        list: instances of class Contig
+    """
+    contig_ids = arrays["contig_id"].tolist()
+    sequences = arrays["sequences"].tobytes().decode()
+    all_reads = [{} for _ in contig_ids]
+    for contig_number, read_id, (sstart, send, qstart, qend) in zip(
+        arrays["read_contig"].tolist(),
+        arrays["read_id"].tolist(),
+        arrays["read_positions"].tolist(),
+    ):
+        all_reads[contig_number][read_id] = {
+            "sseqid": read_id,
+            "qseqid": contig_ids[contig_number],
+            "sstart": sstart,
+            "send": send,
+            "qstart": qstart,
+            "qend": qend,
+        }
+    contigs = []
+    start = 0
+    for contig_id, direction, sequence_length, reads in zip(
+        contig_ids,
+        arrays["direction"].tolist(),
+        arrays["sequence_length"].tolist(),
+        all_reads,
+    ):
+        sequence = sequences[start : start + sequence_length]
+        start += sequence_length
+        contigs.append(Contig(contig_id, reads, sequence, direction))
+    return contigs
+
+
+def cached_stage(cache, key, run, to_arrays, from_arrays, refresh=False):
+    """
+    load the output of a stage from the cache, or run the stage and store its output
+
+    Args:
+        cache (StageCache): cache to use, the stage is always run if None
+        key (str): cache key of the stage made by stage_key
+        run (function): runs the stage and returns its output
+        to_arrays (function): converts the output into arrays, or None if it cannot be cached
+        from_arrays (function): converts cached arrays back into the output
+        refresh (bool): if True, run the stage even if it is cached (to save intermediate outputs)
+
+    Returns:
+        output of the stage
+    """
+    if cache is None:
+        return run()
+    if not refresh:
+        arrays = cache.load(key)
+        if arrays is not None:
+            print(f"{datetime.datetime.now()}: loaded {key} from the cache")
+            return from_arrays(arrays)
+    output = run()
+    arrays = to_arrays(output)
+    if arrays is not None:
+        cache.save(key, arrays)
+    return output
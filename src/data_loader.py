@@ -5,78 +5,373 @@ __date__ = "2023/03/06"
 Functions needed to read in input files    
 """
 
+import gzip
+import mmap
+import os
+from collections.abc import Mapping
 
-def parse_query(fp):
+import numpy as np
+
+# first two bytes of a gzip (or bgzip) file
+GZIP_MAGIC = b"\x1f\x8b"
+# suffix of the offset index saved beside a reads file
+INDEX_SUFFIX = ".index"
+# lookup tables of the byte values allowed in a sequence, without and with N
+VALID_BASES = np.zeros(256, dtype=bool)
+VALID_BASES[list(b"ATCG")] = True
+VALID_BASES_N = VALID_BASES.copy()
+VALID_BASES_N[ord("N")] = True
+
+
+def find_invalid_base(sequence, allow_n=False):
+    """
+    find the first character of a sequence that is not a valid base
+
+    Args:
+        sequence (str or bytes): sequence to check
+        allow_n (bool): whether to accept N bases
+
+    Returns:
+        int: position of the first invalid base, or -1 if the sequence is valid
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode()
+    table = VALID_BASES_N if allow_n else VALID_BASES
+    valid = table[np.frombuffer(sequence, dtype=np.uint8)]
+    if valid.all():
+        return -1
+    return int(np.argmin(valid))
+
+
+def validate_sequences(records, error, allow_n=False, chunk_size=1 << 20):
+    """
+    check that all sequences only contain valid bases, a chunk of records at a time
+
+    Records are checked as they arrive in chunks of about chunk_size bases, so short
+    reads are checked together without holding every sequence in one buffer.
+
+    Args:
+        records (iterable): touples of sequence id and sequence
+        error (str): message of the exception raised for an invalid sequence
+        allow_n (bool): whether to accept N bases
+        chunk_size (int): number of bases to check at once
+
+    Raises:
+        Exception: if any sequence contains a character other than ATCG (or N if allowed),
+        reporting the first offending record and position
+    """
+    chunk = []
+    bases = 0
+    for record in records:
+        chunk.append(record)
+        bases += len(record[1])
+        if bases >= chunk_size:
+            validate_chunk(chunk, error, allow_n)
+            chunk = []
+            bases = 0
+    if chunk:
+        validate_chunk(chunk, error, allow_n)
+
+
+def validate_chunk(records, error, allow_n=False):
+    """
+    check the sequences of a chunk of records in a single pass over all of them
+
+    Args:
+        records (list): touples of sequence id and sequence
+        error (str): message of the exception raised for an invalid sequence
+        allow_n (bool): whether to accept N bases
+
+    Raises:
+        Exception: if any sequence contains a character other than ATCG (or N if allowed),
+        reporting the first offending record and position
+    """
+    buffer = "".join(sequence for _, sequence in records).encode()
+    position = find_invalid_base(buffer, allow_n)
+    if position == -1:
+        return
+    ends = np.cumsum([len(sequence) for _, sequence in records])
+    record = int(np.searchsorted(ends, position, side="right"))
+    read_id, sequence = records[record]
+    column = position - (ends[record] - len(sequence))
+    raise Exception(
+        f"{error}: found '{sequence[column]}' in {read_id} at position {column}"
+    )
+
+
+def is_gzipped(fp):
+    """
+    check whether a file is gzip or bgzip compressed
+
+    Args:
+        fp (str): path to file
+
+    Returns:
+        bool: True if the file starts with the gzip magic bytes
+    """
+    with open(fp, "rb") as file:
+        return file.read(2) == GZIP_MAGIC
+
+
+def open_fasta(fp):
+    """
+    open a fasta file for reading text, decompressing it if it is gzipped
+
+    Args:
+        fp (str): path to fasta file (may be gzip or bgzip compressed)
+
+    Returns:
+        file: text file object
+    """
+    if is_gzipped(fp):
+        return gzip.open(fp, "rt")
+    return open(fp, "r")
+
+
+def read_fasta(fp, name="Sequences"):
+    """
+    stream records from a fasta file one at a time
+
+    Sequences may be wrapped over several lines and the file may be gzip or bgzip compressed.
+    Only the record being read is held in memory.
+
+    Args:
+        fp (str): path to fasta file
+        name (str): description of the file used in error messages
+
+    Raises:
+        Exception: if the first line does not start with '>'
+        Exception: if a record has no sequence
+
+    Yields:
+        touple: sequence id and upper case sequence of each record
+    """
+    with open_fasta(fp) as file:
+        read_id = None
+        lines = []
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(">"):
+                if read_id is not None:
+                    if not lines:
+                        raise Exception(f"{name} must be a FASTA file")
+                    yield read_id, "".join(lines).upper()
+                # remove > from line and any surrounding whitespace
+                read_id = line[1:].strip()
+                lines = []
+            elif read_id is None:
+                raise Exception(f"{name} must be a FASTA file")
+            else:
+                lines.append(line)
+        if read_id is None or not lines:
+            raise Exception(f"{name} must be a FASTA file")
+        yield read_id, "".join(lines).upper()
+
+
+def parse_query(fp, allow_n=False):
     """
     parse query sequence from fasta file
 
     Args:
         fp (str): path to query fasta
+        allow_n (bool): whether to accept N bases
 
     Raises:
-        Exception: is less than two lines
-        Exception: if more than two lines
+        Exception: if the file is not a FASTA file
+        Exception: if the file contains more than one sequence
         Exception: if file contains any letters besided ACTG
         Exception: if sequence id lines do not start with '>'
 
     Returns:
         str: sequence of query
     """
-    nucleotides = set("ATCG")
-    with open(fp, "r") as file:
-        lines = file.readlines()
-        if len(lines) < 2:
-            raise Exception("Query sequence must be a FASTA file")
-        elif len(lines) > 2:
-            raise Exception("Query sequence must be a FASTA file with only one entry")
-        if lines[0].startswith(">"):
-            sequence = lines[1].upper().strip()
-            if set(sequence) > nucleotides:
-                raise Exception("Query must be a DNA sequence")
-            return sequence
-        else:
-            raise Exception("Query sequence must be a FASTA file")
+    records = read_fasta(fp, "Query sequence")
+    read_id, sequence = next(records)
+    if next(records, None) is not None:
+        raise Exception("Query sequence must be a FASTA file with only one entry")
+    validate_sequences([(read_id, sequence)], "Query must be a DNA sequence", allow_n)
+    return sequence
+
+
+def parse_queries(fp, allow_n=False):
+    """
+    parse one or more query sequences from a fasta file
+
+    Args:
+        fp (str): path to query fasta
+        allow_n (bool): whether to accept N bases
+
+    Raises:
+        Exception: if the file is not a FASTA file
+        Exception: if two queries have the same id
+        Exception: if file contains any letters besided ACTG
+
+    Returns:
+        dict: queries with query id (key) and sequence (value), in the order of the file
+    """
+    query_dict = {}
+    for query_id, sequence in read_fasta(fp, "Query sequence"):
+        if query_id in query_dict:
+            raise Exception(f"Query id {query_id} is used more than once")
+        query_dict[query_id] = sequence
+    validate_sequences(query_dict.items(), "Query must be a DNA sequence", allow_n)
+    return query_dict
 
 
-def parse_reads(fp):
+def parse_reads(fp, allow_n=False):
     """
     create dictionaries of reads
 
     Args:
         fp (str): path to reads fasta file
+        allow_n (bool): whether to accept N bases
 
     Raises:
-        Exception: if unequal number of lines
+        Exception: if the file is not a FASTA file
         Exception: if only one read
         Exception: if sequence id lines do not start with '>'
         Exception: if file contains any letters besided ACTG
 
     Returns:
-        dicts: dictionaries of forward and reverse reads with read id (key) and sequence (value)
-    """
-    nucleotides = set("ATCG")
-    fwd_read_dict = {}
-    rvs_read_dict = {}
-    with open(fp, "r") as file:
-        lines = file.readlines()
-        if len(lines) % 2 != 0:
-            raise Exception("Reads must be a FASTA file")
-        elif len(lines) == 2:
+        dict: reads with read id (key) and sequence (value)
+    """
+    read_dict = {}
+    for read_id, sequence in read_fasta(fp, "Reads"):
+        read_dict[read_id] = sequence
+    validate_sequences(read_dict.items(), "Reads must be DNA sequences", allow_n)
+    if len(read_dict) == 1:
+        raise Exception(
+            "Reads FASTA file must contain more than one sequence to assemble"
+        )
+
+    return read_dict
+
+
+def build_fasta_index(fp, allow_n=False):
+    """
+    find where the sequence of each record is stored in an uncompressed fasta file
+
+    Args:
+        fp (str): path to reads fasta file
+        allow_n (bool): whether to accept N bases
+
+    Raises:
+        Exception: if the file is not a FASTA file
+        Exception: if file contains any letters besided ACTG
+
+    Returns:
+        dict: read ids (keys) and touples of sequence length, byte offset of the sequence and
+        number of bytes the sequence spans including line breaks (values)
+    """
+    index = {}
+    read_id = None
+    offset = 0
+    with open(fp, "rb") as file:
+        for line in file:
+            if line.startswith(b">"):
+                if read_id is not None:
+                    if length == 0:
+                        raise Exception("Reads must be a FASTA file")
+                    index[read_id] = (length, start, end - start)
+                read_id = line[1:].strip().decode()
+                start = offset + len(line)
+                end = start
+                length = 0
+            elif line.strip():
+                if read_id is None:
+                    raise Exception("Reads must be a FASTA file")
+                sequence = line.strip().upper()
+                column = find_invalid_base(sequence, allow_n)
+                if column != -1:
+                    raise Exception(
+                        f"Reads must be DNA sequences: found '{chr(sequence[column])}' in {read_id} at position {length + column}"
+                    )
+                length += len(sequence)
+                end = offset + len(line.rstrip())
+            offset += len(line)
+    if read_id is None or length == 0:
+        raise Exception("Reads must be a FASTA file")
+    index[read_id] = (length, start, end - start)
+    return index
+
+
+def load_fasta_index(fp, allow_n=False):
+    """
+    load the offset index saved beside a fasta file, building and saving it if it is missing or out of date
+
+    The index is reused as long as the size and modification time of the fasta file are unchanged.
+
+    Args:
+        fp (str): path to reads fasta file
+        allow_n (bool): whether to accept N bases
+
+    Returns:
+        dict: read ids (keys) and touples of sequence length, byte offset and byte span (values)
+    """
+    stat = os.stat(fp)
+    # the index was validated with the allowed bases, so they are part of the header
+    header = f"#\t{stat.st_size}\t{stat.st_mtime_ns}\t{allow_n}\n"
+    index_fp = fp + INDEX_SUFFIX
+    if os.path.exists(index_fp):
+        with open(index_fp, "r") as file:
+            if file.readline() == header:
+                index = {}
+                for line in file:
+                    read_id, length, start, span = line.rstrip("\n").split("\t")
+                    index[read_id] = (int(length), int(start), int(span))
+                return index
+    index = build_fasta_index(fp, allow_n)
+    try:
+        with open(index_fp, "w") as file:
+            file.write(header)
+            for read_id, (length, start, span) in index.items():
+                file.write(f"{read_id}\t{length}\t{start}\t{span}\n")
+    except OSError:
+        # the index is only a cache, so a read only directory is not an error
+        pass
+    return index
+
+
+class IndexedReads(Mapping):
+    """
+    read only dictionary of reads that fetches sequences from a memory mapped fasta file on demand
+    """
+
+    def __init__(self, fp, allow_n=False):
+        if is_gzipped(fp):
+            raise Exception("Indexed reads must be an uncompressed FASTA file")
+        self.index = load_fasta_index(fp, allow_n)
+        if len(self.index) == 1:
             raise Exception(
                 "Reads FASTA file must contain more than one sequence to assemble"
             )
-        i = 0
-        while i < len(lines):
-            read_id = lines[i]
-            if not read_id.startswith(">"):
-                raise Exception("Reads must be a FASTA file")
-            # remove > from line and any trailing whitespace
-            read_id = read_id[1:].strip()
-            sequence = lines[i + 1].upper().strip()
-            if set(sequence) > nucleotides:
-                raise Exception("Reads must be DNA sequences")
-            fwd_read_dict[read_id] = sequence
-            rvs_read_dict[read_id] = sequence[::-1]
-            i += 2
-
-    return fwd_read_dict, rvs_read_dict
+        with open(fp, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def fetch(self, read_id):
+        """
+        get the bytes of a read sequence without copying single line sequences
+
+        Args:
+            read_id (str): id of the read
+
+        Returns:
+            memoryview or bytes: sequence of the read as stored in the file
+        """
+        length, start, span = self.index[read_id]
+        sequence = memoryview(self.buffer)[start : start + span]
+        if span == length:
+            return sequence
+        # wrapped sequences have to be joined
+        return b"".join(bytes(sequence).split())
+
+    def __getitem__(self, read_id):
+        return bytes(self.fetch(read_id)).decode().upper()
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
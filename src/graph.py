@@ -5,16 +5,31 @@ __date__ = "2023/04/09"
 Functions needed to assemble de bruijn graphs   
 """
 
+import csv
 import datetime
 
+import numpy as np
 import pandas as pd
 
+from src.kmers import (
+    BASES,
+    KmerTable,
+    decode_kmer,
+    kmer_dtype,
+    reverse_complement_code,
+)
+
+# graphs with more nodes than this are saved as an edge list instead of a dense matrix
+MAX_DENSE_NODES = 5000
+
 
 class Paths:
     """
     holds information about the path through the graph between a start and stop node
     """
 
+    __slots__ = ("contig_id", "start_node", "stop_node", "path")
+
     def __init__(self, contig_id, start_node, stop_node, path):
         self.contig_id = contig_id
         self.start_node = start_node
@@ -33,15 +48,373 @@ def create_graph(kmers):
     Returns:
         list: list of touples containing a source node and a target node
     """
+    # index kmers by their prefix so successors can be looked up directly
+    # the first kmer is never used as a target, matching the original all-pairs scan
+    prefix_index = {}
+    for kmer in kmers[1:]:
+        if kmer.prefix_code in prefix_index:
+            prefix_index[kmer.prefix_code].append(kmer)
+        else:
+            prefix_index[kmer.prefix_code] = [kmer]
     edges = []
-    for k1 in range(len(kmers)):
-        for k2 in range(1, len(kmers)):
-            if kmers[k1].sufix == kmers[k2].prefix:
-                edges.append([kmers[k1], kmers[k2]])
+    for kmer in kmers:
+        for target in prefix_index.get(kmer.suffix_code, []):
+            edges.append([kmer, target])
     print(f"{datetime.datetime.now()}: found all edges of the graph")
     return edges
 
 
+class Graph:
+    """
+    sparse de bruijn graph stored as adjacency lists keyed by integer node ids
+    """
+
+    def __init__(
+        self,
+        nodes,
+        successors,
+        members=None,
+        kmer_nodes=None,
+        k=None,
+        canonical=False,
+    ):
+        # nodes are kmer codes if k is given, otherwise sequences
+        self.nodes = nodes
+        self.k = k
+        # canonical graphs hold both orientations of every kmer
+        self.canonical = canonical
+        self.node_ids = {node: node_id for node_id, node in enumerate(nodes)}
+        self.successors = successors
+        # for compacted graphs, the ids of the kmer nodes that make up each unitig
+        self.members = members
+        self.kmer_nodes = kmer_nodes
+        # degrees are computed once here so sources and sinks can be found in linear time
+        self.out_degree = np.array([len(targets) for targets in successors], dtype=int)
+        targets = [target for node_targets in successors for target in node_targets]
+        self.in_degree = np.bincount(np.array(targets, dtype=int), minlength=len(nodes))
+
+    def edges(self):
+        """
+        iterate over all edges of the graph
+
+        Yields:
+            touple: source node id and target node id
+        """
+        for source, targets in enumerate(self.successors):
+            for target in targets:
+                yield source, target
+
+    def sequence(self, node_id):
+        """
+        get the sequence of a node
+
+        Args:
+            node_id (int): id of a node in the graph
+
+        Returns:
+            str: sequence of the node
+        """
+        if self.k is None:
+            return self.nodes[node_id]
+        return decode_kmer(self.nodes[node_id], self.k)
+
+    def last_base(self, node_id):
+        """
+        get the last base of a node without decoding the whole sequence
+
+        Args:
+            node_id (int): id of a node in the graph
+
+        Returns:
+            str: last base of the node
+        """
+        if self.k is None:
+            return self.nodes[node_id][-1]
+        return BASES[self.nodes[node_id] & 3]
+
+    def kmer_count(self, node_id):
+        """
+        get the number of kmers that make up a node
+
+        Args:
+            node_id (int): id of a node in the graph
+
+        Returns:
+            int: number of kmers in the node (1 unless the graph is compacted)
+        """
+        if self.members is None:
+            return 1
+        return len(self.members[node_id])
+
+    def expand(self, node_id):
+        """
+        get the kmer nodes that make up a node
+
+        Args:
+            node_id (int): id of a node in the graph
+
+        Returns:
+            list: kmer nodes in path order (a single kmer unless the graph is compacted)
+        """
+        if self.members is None:
+            return [self.nodes[node_id]]
+        return [self.kmer_nodes[member] for member in self.members[node_id]]
+
+
+# turn edges into a sparse graph
+def create_sparse_graph(kmers, edges):
+    """
+    turn edge list into adjacency lists over integer node ids
+
+    Args:
+        kmers (list): instances of class Kmers present in the reads
+        edges (list): touples of start and stop nodes
+
+    Returns:
+        Graph: sparse graph with one node per distinct kmer code
+    """
+    node_ids = {}
+    for kmer in kmers:
+        if kmer.code not in node_ids:
+            node_ids[kmer.code] = len(node_ids)
+    targets = [set() for _ in node_ids]
+    for edge1, edge2 in edges:
+        targets[node_ids[edge1.code]].add(node_ids[edge2.code])
+    # neighbors are kept in node order so traversal matches the adjacency matrix
+    successors = [sorted(node_targets) for node_targets in targets]
+    k = kmers[0].k if kmers else None
+    graph = Graph(list(node_ids), successors, k=k)
+    print(f"{datetime.datetime.now()}: created sparse graph")
+    return graph
+
+
+def compact_graph(graph):
+    """
+    collapse non-branching chains of kmers into unitig nodes
+
+    Args:
+        graph (Graph): sparse graph with one node per kmer
+
+    Returns:
+        Graph: graph where each node is a unitig, with the kmer nodes it contains stored as members
+    """
+    # a node is merged into its predecessor if it is that predecessor's only successor
+    # and the predecessor is its only parent
+    predecessor = [None] * len(graph.nodes)
+    for source, target in graph.edges():
+        predecessor[target] = source
+    mergeable = [
+        graph.in_degree[node_id] == 1
+        and predecessor[node_id] != node_id
+        and graph.out_degree[predecessor[node_id]] == 1
+        for node_id in range(len(graph.nodes))
+    ]
+    members = []
+    unitig_ids = [None] * len(graph.nodes)
+    for node_id in range(len(graph.nodes)):
+        if mergeable[node_id]:
+            continue
+        chain = [node_id]
+        while graph.out_degree[chain[-1]] == 1:
+            next_node = graph.successors[chain[-1]][0]
+            if not mergeable[next_node]:
+                break
+            chain.append(next_node)
+        for member in chain:
+            unitig_ids[member] = len(members)
+        members.append(chain)
+    # nodes in isolated cycles have no chain head and are kept as single nodes
+    for node_id in range(len(graph.nodes)):
+        if unitig_ids[node_id] is None:
+            unitig_ids[node_id] = len(members)
+            members.append([node_id])
+
+    nodes = []
+    successors = []
+    for chain in members:
+        first = graph.sequence(chain[0])
+        nodes.append(first + "".join(graph.last_base(member) for member in chain[1:]))
+        successors.append(
+            sorted(unitig_ids[target] for target in graph.successors[chain[-1]])
+        )
+    unitigs = Graph(nodes, successors, members=members, kmer_nodes=graph.nodes)
+    print(
+        f"{datetime.datetime.now()}: compacted {len(graph.nodes)} nodes into {len(nodes)} unitigs"
+    )
+    return unitigs
+
+
+def create_table_graph(table):
+    """
+    create a sparse graph directly from the arrays of a kmer table
+
+    Gives the same graph as create_sparse_graph(kmers, create_graph(kmers)) without
+    building an instance of class Kmer for every position.
+
+    For canonical tables the graph is bidirected: every canonical kmer is visited in both
+    orientations, so it has one node for the kmer as it was first read followed by one
+    for its reverse complement (palindromic kmers only have one node).
+
+    Args:
+        table (KmerTable): kmers that make up all reads
+
+    Returns:
+        Graph: sparse graph with one node per distinct kmer code
+    """
+    return create_streamed_graph([table])
+
+
+def create_streamed_graph(tables):
+    """
+    create a sparse graph from batches of kmers, such as those made by get_all_kmers with lazy=True
+
+    Only the distinct kmer codes are kept between batches, so memory is bounded by the
+    number of nodes rather than the number of kmers in the reads.
+
+    Args:
+        tables (iterable): instances of class KmerTable in read order
+
+    Returns:
+        Graph: the same graph as create_table_graph on all kmers at once
+    """
+    seen = None
+    new_codes = []
+    new_strands = []
+    first_code = None
+    first_repeated = False
+    k = None
+    canonical = False
+    for table in tables:
+        k = table.k
+        canonical = table.canonical
+        codes = table.code
+        if len(codes) == 0:
+            continue
+        if first_code is None:
+            first_code = codes[0]
+            first_repeated = bool(np.any(codes[1:] == first_code))
+        elif not first_repeated:
+            first_repeated = bool(np.any(codes == first_code))
+        unique_codes, first_rows = np.unique(codes, return_index=True)
+        if seen is not None:
+            # seen stays sorted, so the batch codes are found and merged in with a binary search
+            positions = np.searchsorted(seen, unique_codes)
+            found = positions < len(seen)
+            found[found] = seen[positions[found]] == unique_codes[found]
+            is_new = ~found
+            unique_codes = unique_codes[is_new]
+            first_rows = first_rows[is_new]
+            seen = np.insert(seen, positions[is_new], unique_codes)
+        else:
+            seen = unique_codes
+        # nodes are numbered in order of first appearance like create_sparse_graph
+        order = np.argsort(first_rows, kind="stable")
+        new_codes.append(unique_codes[order])
+        new_strands.append(table.direction[first_rows[order]])
+    if k is None:
+        return Graph([], [])
+    if new_codes:
+        node_codes = np.concatenate(new_codes)
+        first_strand = np.concatenate(new_strands)
+    else:
+        node_codes = np.zeros(0, dtype=kmer_dtype(k))
+        first_strand = np.zeros(0, dtype=np.int8)
+    if canonical:
+        reverse = reverse_complement_code(node_codes, k)
+        read_codes = np.where(first_strand == 1, node_codes, reverse)
+        other_codes = np.where(first_strand == 1, reverse, node_codes)
+        is_palindrome = np.repeat(reverse == node_codes, 2)
+        is_palindrome[::2] = False
+        node_codes = np.stack([read_codes, other_codes], axis=1).ravel()
+        node_codes = node_codes[~is_palindrome]
+        # both orientations of every kmer can be reached from a neighbor
+        is_target = np.ones(len(node_codes), dtype=bool)
+    else:
+        # like create_graph, the first kmer is only a target if its code appears again
+        is_target = np.ones(len(node_codes), dtype=bool)
+        if len(node_codes) > 0 and not first_repeated:
+            is_target[0] = False
+    suffix_mask = (1 << (2 * (k - 1))) - 1
+    if node_codes.dtype != object:
+        suffix_mask = node_codes.dtype.type(suffix_mask)
+    suffixes = node_codes & suffix_mask
+    targets = np.flatnonzero(is_target)
+    target_prefixes = node_codes[targets] >> 2
+    order = np.argsort(target_prefixes, kind="stable")
+    targets = targets[order]
+    target_prefixes = target_prefixes[order]
+    low = np.searchsorted(target_prefixes, suffixes, side="left")
+    high = np.searchsorted(target_prefixes, suffixes, side="right")
+    successors = [
+        sorted(targets[low[node_id] : high[node_id]].tolist())
+        for node_id in range(len(node_codes))
+    ]
+    graph = Graph(node_codes.tolist(), successors, k=k, canonical=canonical)
+    print(f"{datetime.datetime.now()}: created sparse graph")
+    return graph
+
+
+def drop_reverse_complement_paths(all_paths, k):
+    """
+    skip paths that spell the reverse complement of a path that was already found
+
+    In a bidirected graph every contig is found once on each strand, only the first
+    of the two is kept and contig ids are renumbered to stay consecutive.
+
+    Args:
+        all_paths (generator): instances of class Path through a bidirected graph
+        k (int): length of kmers
+
+    Yields:
+        Path: paths that are not the reverse complement of an earlier path
+    """
+    seen = set()
+    contig_id = 0
+    for path in all_paths:
+        reverse = tuple(
+            reverse_complement_code(node, k) for node in reversed(path.path)
+        )
+        if reverse in seen:
+            continue
+        seen.add(tuple(path.path))
+        path.contig_id = contig_id
+        contig_id += 1
+        yield path
+
+
+def graph_from_adjacency_matrix(adj_matrix):
+    """
+    convert a dense adjacency matrix into a sparse graph
+
+    Args:
+        adj_matrix (pandas.DataFrame): adjacency matrix where source node are rows and target nodes are columns
+
+    Returns:
+        Graph: sparse graph with the same nodes and edges
+    """
+    nodes = list(adj_matrix.columns)
+    values = adj_matrix.loc[nodes, nodes].to_numpy()
+    successors = [np.flatnonzero(row).tolist() for row in values]
+    return Graph(nodes, successors)
+
+
+def to_adjacency_matrix(graph):
+    """
+    convert a sparse graph into a dense adjacency matrix
+
+    Args:
+        graph (Graph): sparse graph
+
+    Returns:
+        pandas.DataFrame: adjacency matrix where source node are rows and target nodes are columns
+    """
+    values = np.zeros((len(graph.nodes), len(graph.nodes)), dtype=int)
+    for source, target in graph.edges():
+        values[source, target] = 1
+    labels = [graph.sequence(node_id) for node_id in range(len(graph.nodes))]
+    return pd.DataFrame(values, index=labels, columns=labels)
+
+
 # turn edges into an adjaceny matrix
 def create_adjacency_matrix(kmers, edges, save, out_dir):
     """
@@ -55,120 +428,177 @@ def create_adjacency_matrix(kmers, edges, save, out_dir):
     Returns:
         pandas.DataFrame: adjacency matrix where source node are rows and target nodes are columns
     """
-    nodes = []
-    for kmer in kmers:
-        if kmer.sequence not in nodes:
-            nodes.append(kmer.sequence)
-    adj_matrix = pd.DataFrame(0, index=nodes, columns=nodes)
-    for edge1, edge2 in edges:
-        source = edge1.sequence
-        target = edge2.sequence
-        adj_matrix.loc[source, target] = 1
-    adj_matrix = adj_matrix.astype(int)
+    adj_matrix = to_adjacency_matrix(create_sparse_graph(kmers, edges))
     print(f"{datetime.datetime.now()}: created adjacency matrix")
     if save:
         adj_matrix.to_csv(f"{out_dir}/adjacency_matrix.csv")
     return adj_matrix
 
 
-def find_start_stop_nodes(adj_matrix):
+def save_graph(graph, out_dir, max_dense_nodes=MAX_DENSE_NODES):
+    """
+    save the graph as an adjacency matrix, or as an edge list if the graph is large
+
+    Args:
+        graph (Graph): sparse graph
+        out_dir (str): directory to save the output file
+        max_dense_nodes (int): largest number of nodes to write as a dense matrix
     """
-    Finds all possible start and stop nodes in a directed graph represented by an adjacency matrix.
+    if len(graph.nodes) <= max_dense_nodes:
+        to_adjacency_matrix(graph).to_csv(f"{out_dir}/adjacency_matrix.csv")
+    else:
+        with open(f"{out_dir}/edge_list.csv", "w") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["source", "target"])
+            for source, target in graph.edges():
+                writer.writerow([graph.sequence(source), graph.sequence(target)])
+    print(f"{datetime.datetime.now()}: saved graph")
+
+
+def find_start_stop_nodes(graph):
+    """
+    Finds all possible start and stop nodes in a directed graph.
 
     Parameters:
-        adj_matrix (pandas.DataFrame): The adjacency matrix of the graph.
+        graph (Graph or pandas.DataFrame): The sparse graph or adjacency matrix of the graph.
 
     Returns:
         A tuple containing two lists: a list of all possible start nodes, and a list of all possible
         stop nodes. Each list contains the node labels as strings.
     """
-    # initialize sets of start and stop nodes
-    start_nodes = list(adj_matrix.columns)
-    stop_nodes = list(adj_matrix.columns)
-
-    # iterate over the rows and columns of the adjacency matrix
-    for node in adj_matrix.index:
-        if any(adj_matrix.loc[:, node] != 0):
-            start_nodes.remove(node)
-        if any(adj_matrix.loc[node, :] != 0):
-            stop_nodes.remove(node)
+    if isinstance(graph, pd.DataFrame):
+        graph = graph_from_adjacency_matrix(graph)
+    start_nodes = [
+        graph.nodes[node_id] for node_id in np.flatnonzero(graph.in_degree == 0)
+    ]
+    stop_ids = np.flatnonzero(graph.out_degree == 0)
+    if graph.members is not None:
+        # order unitigs by their last kmer so paths come out in the same order as before compaction
+        stop_ids = sorted(stop_ids, key=lambda node_id: graph.members[node_id][-1])
+    stop_nodes = [graph.nodes[node_id] for node_id in stop_ids]
     if len(start_nodes) == 0:
         raise Exception("No start nodes found, graph is cyclic")
     if len(stop_nodes) == 0:
         raise Exception("No stop nodes found, graph is cyclic")
 
-    # convert the sets to lists and return the result
     print(f"{datetime.datetime.now()}: found all start and stop nodes")
-    return list(start_nodes), list(stop_nodes)
+    return start_nodes, stop_nodes
 
 
-def find_all_paths(adj_matrix):
+def trace_path(graph, link):
+    """
+    rebuild a path from the parent pointers stored during traversal
+
+    Args:
+        graph (Graph): graph that was traversed
+        link (tuple): last node id of the path and the link to its parent (None at the start node)
+
+    Returns:
+        list: kmer nodes from the start node to the last node
+    """
+    node_ids = []
+    while link is not None:
+        node_id, link = link
+        node_ids.append(node_id)
+    kmer_path = []
+    for node_id in reversed(node_ids):
+        kmer_path.extend(graph.expand(node_id))
+    return kmer_path
+
+
+def find_all_paths(graph, max_paths=None):
     """
     Finds all possible paths in a directed graph.
 
+    A single depth-first-search is run from each start node and every stop node it reaches
+    is recorded. Paths are stored as parent pointers during the search and yielded once all
+    paths from a start node have been found, ordered by stop node.
+
     Parameters:
-        adj_matrix (pandas.DataFrame): The adjacency matrix of the graph.
+        graph (Graph or pandas.DataFrame): The sparse graph or adjacency matrix of the graph.
+        max_paths (int): stop after this many paths have been found (no limit if None)
 
-    Returns:
-        list : instance of class Path representing all possible paths between start and stop nodes
+    Yields:
+        Paths : instance of class Path representing a path between a start and stop node
     """
+    if isinstance(graph, pd.DataFrame):
+        graph = graph_from_adjacency_matrix(graph)
     # find all possible start and stop nodes
-    start_nodes, stop_nodes = find_start_stop_nodes(adj_matrix)
+    start_nodes, stop_nodes = find_start_stop_nodes(graph)
+    stop_order = {graph.node_ids[node]: rank for rank, node in enumerate(stop_nodes)}
 
-    # initialize the result dictionary
-    all_paths = []
     contig_id = 0
-    # iterate over all pairs of start and stop nodes
     for start_node in start_nodes:
-        for stop_node in stop_nodes:
-            # skip pairs where the start and stop nodes are the same
-            if start_node == stop_node:
-                continue
-            visited = set()
-            stack = [(start_node, [start_node])]
-            paths = []
-
-            while stack:
-                (node, path) = stack.pop()
-                if node == stop_node:
-                    paths.append(path)
+        start_id = graph.node_ids[start_node]
+        visited = set()
+        stack = [(start_id, None)]
+        paths = []
+
+        while stack:
+            if max_paths is not None and contig_id + len(paths) >= max_paths:
+                break
+            node, parent = stack.pop()
+            link = (node, parent)
+            if node in stop_order:
+                # a start node is only a path on its own if it is a unitig of several kmers
+                if node == start_id and graph.kmer_count(node) == 1:
                     continue
+                # a stop unitig longer than one kmer is entered through its first kmer,
+                # which can only be visited once
                 if node in visited:
-                    # if we get to a cycle, discard the path
                     continue
-                visited.add(node)
-                for neighbor in adj_matrix.loc[node, :][
-                    adj_matrix.loc[node, :] != 0
-                ].index:
-                    stack.append((neighbor, path + [neighbor]))
-
-            # add the paths to the result dictionary
-            if paths:
-                for path in paths:
-                    p = Paths(
-                        contig_id=contig_id,
-                        start_node=start_node,
-                        stop_node=stop_node,
-                        path=path,
-                    )
-                    all_paths.append(p)
-                    contig_id += 1
-    print(f"{datetime.datetime.now()}: found {len(all_paths)} paths through the graph")
-    return all_paths
+                if graph.kmer_count(node) > 1:
+                    visited.add(node)
+                paths.append((stop_order[node], link))
+                continue
+            if node in visited:
+                # if we get to a cycle, discard the path
+                continue
+            visited.add(node)
+            for neighbor in graph.successors[node]:
+                stack.append((neighbor, link))
+
+        # sort is stable, so paths to the same stop node keep the order they were found in
+        paths.sort(key=lambda path: path[0])
+        for _, link in paths:
+            kmer_path = trace_path(graph, link)
+            yield Paths(
+                contig_id=contig_id,
+                start_node=kmer_path[0],
+                stop_node=kmer_path[-1],
+                path=kmer_path,
+            )
+            contig_id += 1
+        if max_paths is not None and contig_id >= max_paths:
+            print(f"{datetime.datetime.now()}: reached the limit of {max_paths} paths")
+            break
+    print(f"{datetime.datetime.now()}: found {contig_id} paths through the graph")
 
 
-def graph_traversal(kmers, save, out_dir):
+def graph_traversal(kmers, save, out_dir, max_paths=None):
     """
     wrapper function for creating and traversing graph
 
     Args:
-        kmers (list): instances of class Kmer represening all read kmers
-        save (bool): whether to save adjacency matrix as csv file
+        kmers (KmerTable, list or iterable): kmers represening all reads, or batches of them as instances of class KmerTable
+        save (bool): whether to save the graph as a csv file
+        out_dir (str): directory to save the graph
+        max_paths (int): maximum number of paths to find (no limit if None)
 
     Returns:
-        list: instance of class Path that stores all possible paths through the graph
+        generator: instances of class Path that store all possible paths through the graph
     """
-    edges = create_graph(kmers)
-    adj_matrix = create_adjacency_matrix(kmers, edges, save, out_dir)
-    all_paths = find_all_paths(adj_matrix)
+    if isinstance(kmers, KmerTable):
+        graph = create_table_graph(kmers)
+    elif isinstance(kmers, list):
+        edges = create_graph(kmers)
+        graph = create_sparse_graph(kmers, edges)
+    else:
+        graph = create_streamed_graph(kmers)
+    if save:
+        save_graph(graph, out_dir)
+    unitigs = compact_graph(graph)
+    all_paths = find_all_paths(unitigs, max_paths)
+    if graph.canonical:
+        all_paths = drop_reverse_complement_paths(all_paths, graph.k)
     return all_paths
@@ -3,116 +3,736 @@ __date__ = "2023/03/06"
 
 """
 Classes and functions needed to create kmers
+
+Kmers are stored as integers with two bits per base (A=0, C=1, G=2, T=3), so the
+code of a kmer sorts in the same order as its sequence. Kmers of up to 32 bases fit in
+64 bits, longer kmers simply use larger python integers.
+
+Canonical kmers are keyed by the smaller of the codes of the kmer and its reverse
+complement, with the strand that was read stored as the direction of the kmer.
 """
 
+import csv
+import datetime
+
+import numpy as np
+
+BASES = "ACGT"
+BASE_CODES = {base: code for code, base in enumerate(BASES)}
+# two bit code of every ascii character, 4 marks a base that is not ACGT
+CODE_TABLE = np.full(256, 4, dtype=np.uint8)
+for base, code in BASE_CODES.items():
+    CODE_TABLE[ord(base)] = code
+# complement of each base, N stays N
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def encode_kmer(sequence):
+    """
+    pack a sequence into an integer with two bits per base
+
+    Args:
+        sequence (str): sequence made of the letters ACGT
+
+    Returns:
+        int: code of the sequence
+    """
+    code = 0
+    for base in sequence:
+        code = (code << 2) | BASE_CODES[base]
+    return code
+
+
+def decode_kmer(code, k):
+    """
+    unpack the sequence of a kmer from its code
+
+    Args:
+        code (int): code of the kmer
+        k (int): length of the kmer
+
+    Returns:
+        str: sequence of the kmer
+    """
+    bases = []
+    for _ in range(k):
+        bases.append(BASES[code & 3])
+        code >>= 2
+    return "".join(reversed(bases))
+
+
+def reverse_complement_code(code, k):
+    """
+    compute the code of the reverse complement of a kmer
+
+    Works on single codes and on numpy arrays of codes.
+
+    Args:
+        code (int or np.array): code of the kmer
+        k (int): length of the kmer
+
+    Returns:
+        int or np.array: code of the reverse complement
+    """
+    reverse = code ^ code
+    for _ in range(k):
+        # the complement of a base is 3 minus its code (A-T, C-G)
+        reverse = (reverse << 2) | (3 - (code & 3))
+        code = code >> 2
+    return reverse
+
+
+def reverse_complement(sequence):
+    """
+    compute the reverse complement of a sequence
+
+    Args:
+        sequence (str): sequence made of the letters ACGTN
+
+    Returns:
+        str: reverse complement of the sequence
+    """
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def canonical_code(code, k):
+    """
+    get the canonical code of a kmer and the strand it was read from
+
+    Args:
+        code (int): code of the kmer
+        k (int): length of the kmer
+
+    Returns:
+        touple: smaller of the codes of the kmer and its reverse complement, and 1 if that is the kmer itself or -1 if it is the reverse complement
+    """
+    reverse = reverse_complement_code(code, k)
+    if reverse < code:
+        return reverse, -1
+    return code, 1
+
+
+def encode_kmers(sequence, k):
+    """
+    compute the codes of all kmers in a sequence with a rolling update
+
+    Each code is made from the previous one by shifting in the next base and masking off
+    the base that left the window. Kmers that contain a base other than ACGT are skipped.
+
+    Args:
+        sequence (str): sequence to split into kmers
+        k (int): length of kmers
+
+    Yields:
+        touple: start position and code of each kmer
+    """
+    mask = (1 << (2 * k)) - 1
+    code = 0
+    length = 0
+    for position, base in enumerate(sequence):
+        value = BASE_CODES.get(base)
+        if value is None:
+            # kmers that overlap an unknown base are masked
+            code = 0
+            length = 0
+            continue
+        code = ((code << 2) | value) & mask
+        length += 1
+        if length >= k:
+            yield position - k + 1, code
+
+
+def encode_canonical_kmers(sequence, k):
+    """
+    compute the canonical codes of all kmers in a sequence with a rolling update
+
+    The codes of the kmer and of its reverse complement are updated together, so the
+    reverse strand never has to be built.
+
+    Args:
+        sequence (str): sequence to split into kmers
+        k (int): length of kmers
+
+    Yields:
+        touple: start position, canonical code and strand (1 or -1) of each kmer
+    """
+    mask = (1 << (2 * k)) - 1
+    shift = 2 * (k - 1)
+    forward = 0
+    reverse = 0
+    length = 0
+    for position, base in enumerate(sequence):
+        value = BASE_CODES.get(base)
+        if value is None:
+            forward = 0
+            reverse = 0
+            length = 0
+            continue
+        forward = ((forward << 2) | value) & mask
+        reverse = (reverse >> 2) | ((3 - value) << shift)
+        length += 1
+        if length >= k:
+            if reverse < forward:
+                yield position - k + 1, reverse, -1
+            else:
+                yield position - k + 1, forward, 1
+
 
 class Kmer:
     """
     classes to hold information about kmers
     """
 
-    def __init__(self, read_id, id, sequence, prefix, suffix, start, stop, direction):
+    __slots__ = ("read_id", "id", "code", "k", "start", "stop", "direction")
+
+    def __init__(self, read_id, id, code, k, start, stop, direction):
         self.read_id = read_id
         self.id = id
-        self.sequence = sequence
-        self.prefix = prefix
-        self.sufix = suffix
+        self.code = code
+        self.k = k
         self.start = start
         self.stop = stop
         self.direction = direction
 
+    @property
+    def prefix_code(self):
+        return self.code >> 2
+
+    @property
+    def suffix_code(self):
+        return self.code & ((1 << (2 * (self.k - 1))) - 1)
+
+    @property
+    def sequence(self):
+        return decode_kmer(self.code, self.k)
+
+    @property
+    def prefix(self):
+        return decode_kmer(self.prefix_code, self.k - 1)
+
+    @property
+    def sufix(self):
+        return decode_kmer(self.suffix_code, self.k - 1)
+
+
+def kmer_dtype(k):
+    """
+    get the smallest array type that can hold the code of a kmer
+
+    Args:
+        k (int): length of kmers
+
+    Returns:
+        type: unsigned 64-bit integers for kmers of up to 32 bases, otherwise python objects
+    """
+    if k <= 32:
+        return np.uint64
+    return object
+
+
+def encode_sequences(sequences, k, canonical=False):
+    """
+    compute the codes of all kmers in a list of sequences with vectorized sliding windows
+
+    Sequences are joined into one array so that windows are computed in bulk,
+    windows that cross the end of a sequence or contain a base other than ACGT are skipped.
+
+    Args:
+        sequences (list): sequences to split into kmers
+        k (int): length of kmers
+        canonical (bool): whether to return canonical codes
+
+    Returns:
+        touple: arrays with the sequence index, start position, code and strand of each kmer
+    """
+    empty = (
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0, dtype=kmer_dtype(k)),
+        np.zeros(0, dtype=np.int8),
+    )
+    if len(sequences) == 0:
+        return empty
+    # sequences are separated by an N so no valid window spans two of them
+    joined = "N".join(sequences)
+    values = CODE_TABLE[np.frombuffer(joined.encode("latin-1"), dtype=np.uint8)]
+    n_windows = len(values) - k + 1
+    if n_windows <= 0:
+        return empty
+    invalid = np.concatenate(([0], np.cumsum(values == 4)))
+    valid = np.flatnonzero(invalid[k:] == invalid[:n_windows])
+    dtype = kmer_dtype(k)
+    codes = np.zeros(len(valid), dtype=dtype)
+    for offset in range(k):
+        base_values = values[valid + offset].astype(dtype)
+        codes = (codes << 2) | base_values
+    strands = np.ones(len(valid), dtype=np.int8)
+    if canonical:
+        reverse = reverse_complement_code(codes, k)
+        strands[reverse < codes] = -1
+        codes = np.minimum(codes, reverse)
+    offsets = np.cumsum([0] + [len(sequence) + 1 for sequence in sequences[:-1]])
+    sequence_index = np.searchsorted(offsets, valid, side="right") - 1
+    return sequence_index, valid - offsets[sequence_index], codes, strands
+
+
+class KmerTable:
+    """
+    class to hold kmers as parallel arrays instead of one instance of class Kmer per position
+
+    Iterating over the table or indexing it yields instances of class Kmer, so the
+    table can be used wherever a list of kmers is expected.
+    """
+
+    def __init__(
+        self, read_ids, read_index, id, code, start, direction, k, canonical=False
+    ):
+        self.read_ids = read_ids
+        self.read_index = read_index
+        self.id = id
+        self.code = code
+        self.start = start
+        self.direction = direction
+        self.k = k
+        # canonical tables hold each kmer and its reverse complement under one code
+        self.canonical = canonical
+        self.order = None
+
+    @property
+    def stop(self):
+        return self.start + self.k
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, row):
+        start = int(self.start[row])
+        return Kmer(
+            self.read_ids[self.read_index[row]],
+            int(self.id[row]),
+            int(self.code[row]),
+            self.k,
+            start,
+            start + self.k,
+            int(self.direction[row]),
+        )
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def rows(self, code):
+        """
+        find the rows of all kmers with a code
+
+        Args:
+            code (int): code of the kmer, in either orientation for canonical tables
+
+        Returns:
+            np.array: rows of the kmers sorted by id
+        """
+        if self.canonical:
+            code = canonical_code(code, self.k)[0]
+        if self.order is None:
+            # stable sort keeps kmers with the same code in id order
+            self.order = np.argsort(self.code, kind="stable")
+            self.sorted_code = self.code[self.order]
+        key = self.sorted_code.dtype.type(code)
+        low = np.searchsorted(self.sorted_code, key, side="left")
+        high = np.searchsorted(self.sorted_code, key, side="right")
+        return self.order[low:high]
+
+    def get(self, code, default=None):
+        """
+        get all kmers with a code, so the table can be used like an index made by index_kmers
+
+        Args:
+            code (int): code of the kmer
+            default: value to return if there is no kmer with the code
 
-def create_reads_kmers(read_dict, k, id, direction):
+        Returns:
+            list: instances of class Kmer with the code sorted by id
+        """
+        rows = self.rows(code)
+        if len(rows) == 0:
+            return default
+        return [self[row] for row in rows]
+
+
+def count_kmers(read_dict, k, canonical=False, batch_size=10000):
+    """
+    count how often each kmer occurs in the reads
+
+    Reads are streamed from the loader in batches and the counts are kept as a sorted
+    array of distinct codes with a parallel array of counts.
+
+    Args:
+        read_dict (dict): read ids (keys) and sequences (values)
+        k (int): length of kmers
+        canonical (bool): whether to count canonical codes
+        batch_size (int): number of reads to encode at once
+
+    Returns:
+        touple: sorted array of distinct kmer codes and array of their counts
+    """
+    codes = np.zeros(0, dtype=kmer_dtype(k))
+    counts = np.zeros(0, dtype=np.int64)
+    batch = []
+    for read_id in read_dict:
+        batch.append(read_dict[read_id])
+        if len(batch) == batch_size:
+            codes, counts = add_kmer_counts(codes, counts, batch, k, canonical)
+            batch = []
+    if batch:
+        codes, counts = add_kmer_counts(codes, counts, batch, k, canonical)
+    return codes, counts
+
+
+def add_kmer_counts(codes, counts, sequences, k, canonical):
+    """
+    add the kmers of a batch of sequences to the counts
+
+    Only the batch is sorted, its distinct codes are then merged into the running arrays
+    with a binary search, so codes counted earlier are never sorted again.
+
+    Args:
+        codes (np.array): sorted distinct kmer codes counted so far
+        counts (np.array): counts of the codes
+        sequences (list): sequences to count kmers of
+        k (int): length of kmers
+        canonical (bool): whether to count canonical codes
+
+    Returns:
+        touple: updated sorted array of distinct kmer codes and array of their counts
+    """
+    batch_codes = encode_sequences(sequences, k, canonical)[2]
+    batch_codes, batch_counts = np.unique(batch_codes, return_counts=True)
+    positions = np.searchsorted(codes, batch_codes)
+    seen = positions < len(codes)
+    seen[seen] = codes[positions[seen]] == batch_codes[seen]
+    counts = counts.copy()
+    counts[positions[seen]] += batch_counts[seen]
+    new = ~seen
+    codes = np.insert(codes, positions[new], batch_codes[new])
+    counts = np.insert(counts, positions[new], batch_counts[new])
+    return codes, counts
+
+
+def kmer_spectrum(counts):
+    """
+    compute the kmer spectrum: how many distinct kmers occur each number of times
+
+    Args:
+        counts (np.array): count of each distinct kmer
+
+    Returns:
+        dict: number of occurrences (keys) and number of distinct kmers with that many occurrences (values)
+    """
+    histogram = np.bincount(counts)
+    return {
+        int(occurrences): int(n_kmers)
+        for occurrences, n_kmers in enumerate(histogram)
+        if n_kmers > 0
+    }
+
+
+def save_kmer_spectrum(spectrum, out_dir):
+    """
+    save the kmer spectrum as a csv file
+
+    Args:
+        spectrum (dict): kmer spectrum made by kmer_spectrum
+        out_dir (str): directory to save the spectrum
+    """
+    with open(f"{out_dir}/kmer_spectrum.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["occurrences", "kmers"])
+        for occurrences, n_kmers in spectrum.items():
+            writer.writerow([occurrences, n_kmers])
+
+
+def kmer_counting(read_dict, k, canonical, min_count, save, out_dir, kmer_counts=None):
+    """
+    wrapper function for counting kmers and finding the kmers that occur often enough to keep
+
+    Args:
+        read_dict (dict): read ids (keys) and sequences (values)
+        k (int): length of kmers
+        canonical (bool): whether to count canonical codes
+        min_count (int): kmers that occur fewer times are dropped
+        save (bool): whether to save the kmer spectrum as a csv file
+        out_dir (str): directory to save the kmer spectrum
+        kmer_counts (touple): codes and counts already made by count_kmers, if None the reads are counted
+
+    Returns:
+        np.array: sorted codes of the kmers that occur at least min_count times
+    """
+    if kmer_counts is None:
+        kmer_counts = count_kmers(read_dict, k, canonical)
+    codes, counts = kmer_counts
+    spectrum = kmer_spectrum(counts)
+    print(
+        f"{datetime.datetime.now()}: counted {len(codes)} distinct kmers, kmer spectrum (occurrences: kmers): "
+        + ", ".join(
+            f"{occurrences}: {n_kmers}" for occurrences, n_kmers in spectrum.items()
+        )
+    )
+    if save:
+        save_kmer_spectrum(spectrum, out_dir)
+    solid = codes[counts >= min_count]
+    print(
+        f"{datetime.datetime.now()}: dropped {len(codes) - len(solid)} kmers seen fewer than {min_count} times"
+    )
+    return solid
+
+
+def create_kmer_table(read_dict, k, id, direction, canonical=False, solid=None):
+    """
+    create a table of kmers for reads, skipping kmers that contain an N base
+
+    Args:
+        read_dict (dict): read ids (keys) and sequences (values)
+        k (int): length of kmers
+        id (int): number to use as starting id for first kmer (0 for forward direction)
+        direction (int): 1 for forward or -1 for reverse
+        canonical (bool): whether to key kmers by their canonical code
+        solid (np.array): if given, only kmers with these codes are kept
+
+    Returns:
+        KmerTable: kmers made from reads with the same ids as create_reads_kmers
     """
-    create kmers for reads
+    read_ids = list(read_dict.keys())
+    read_index, start, code, strand = encode_sequences(
+        [read_dict[x] for x in read_ids], k, canonical
+    )
+    if solid is not None:
+        keep = np.isin(code, solid)
+        read_index, start, code, strand = (
+            read_index[keep],
+            start[keep],
+            code[keep],
+            strand[keep],
+        )
+    return KmerTable(
+        read_ids,
+        read_index,
+        np.arange(id, id + len(code), dtype=np.int64),
+        code,
+        start,
+        strand * np.int8(direction),
+        k,
+        canonical,
+    )
+
+
+def create_reads_kmers(read_dict, k, id, direction, canonical=False):
+    """
+    create kmers for reads, skipping kmers that contain an N base
 
     Args:
         read_dict (dict): read ids (keys) and sequences (values)
         k (int): length of kmers
         id (int): number to use as starting id for first kmer (0 for forward direction)
         direction (int): 1 for forward or -1 for reverse
+        canonical (bool): whether to key kmers by their canonical code, the strand is multiplied into the direction
 
     Returns:
         list : instances of class Kmer made from reads, and id to be used for start id for reverse kmers
     """
     kmers = []
     for read_id, read in read_dict.items():
-        for i in range(len(read) - k + 1):
-            start = i
-            stop = i + k
-            sequence = read[start:stop]
-            prefix = sequence[:-1]
-            sufix = sequence[1:]
-            kmer = Kmer(read_id, id, sequence, prefix, sufix, start, stop, direction)
+        if canonical:
+            read_kmers = encode_canonical_kmers(read, k)
+        else:
+            read_kmers = ((start, code, 1) for start, code in encode_kmers(read, k))
+        for start, code, strand in read_kmers:
+            kmer = Kmer(read_id, id, code, k, start, start + k, direction * strand)
             kmers.append(kmer)
             id += 1
     return kmers, id
 
 
-def create_query_kmers(query, k):
+def create_query_kmers(query, k, lazy=False):
     """
     create kmers from query sequence
 
     Args:
         query (str): sequence of query
         k (int): size of kmer
+        lazy (bool): if True, return a generator that makes the kmers as they are needed
 
     Returns:
         list: instances of class Kmer that make up query sequence
     """
-    kmers = []
+    kmers = iter_query_kmers(query, k)
+    if lazy:
+        return kmers
+    return list(kmers)
+
+
+def iter_query_kmers(query, k):
+    """
+    generator version of create_query_kmers
+
+    Args:
+        query (str): sequence of query
+        k (int): size of kmer
+
+    Yields:
+        Kmer: kmers of the query in order
+    """
     id = 0
-    for i in range(len(query) - k + 1):
-        start = i
-        stop = i + k
-        sequence = query[start:stop]
-        prefix = sequence[:-1]
-        sufix = sequence[1:]
-        kmer = Kmer("query", id, sequence, prefix, sufix, start, stop, 1)
-        kmers.append(kmer)
+    for start, code in encode_kmers(query, k):
+        yield Kmer("query", id, code, k, start, start + k, 1)
         id += 1
-    return kmers
 
 
-def get_all_kmers(read_dict, rvs_read_dict, k):
+def get_all_kmers(read_dict, k, canonical=False, solid=None, lazy=False):
     """
-    generate forward and reverse read kmers
+    generate read kmers
+
+    With canonical kmers both strands of every read are covered by a single kmer per
+    position, so no separate reverse reads are needed.
 
     Args:
-        read_dict (dict): forward reads with read ids (key) and sequences (value)
-        rvs_read_dict (dict): reverse reads with read ids (key) and sequences (value)
+        read_dict (dict): reads with read ids (key) and sequences (value)
         k (int): size of kmers
+        canonical (bool): whether to key kmers by their canonical code
+        solid (np.array): if given, only kmers with these codes are kept (made by kmer_counting)
+        lazy (bool): if True, return a generator of tables for batches of reads instead of one table
 
     Returns:
-        list : instances of class Kmers that make up all forward and reverse reads
+        KmerTable : kmers that make up all reads
     """
-    fwd_kmers, id = create_reads_kmers(read_dict, k, 0, 1)
-    # rvs_kmers, id = create_reads_kmers(rvs_read_dict, k, id, -1)
-    return fwd_kmers  # + rvs_kmers
+    if lazy:
+        return iter_kmer_tables(read_dict, k, canonical, solid)
+    return create_kmer_table(read_dict, k, 0, 1, canonical, solid)
+
+
+def iter_kmer_tables(read_dict, k, canonical=False, solid=None, batch_size=10000):
+    """
+    create kmer tables for batches of reads as they are needed
+
+    Kmer ids continue from one batch to the next, so the batches hold the same kmers as
+    a single table made by create_kmer_table.
+
+    Args:
+        read_dict (dict): reads with read ids (key) and sequences (value)
+        k (int): size of kmers
+        canonical (bool): whether to key kmers by their canonical code
+        solid (np.array): if given, only kmers with these codes are kept
+        batch_size (int): number of reads in each table
+
+    Yields:
+        KmerTable: kmers of a batch of reads
+    """
+    id = 0
+    batch = {}
+    for read_id in read_dict:
+        batch[read_id] = read_dict[read_id]
+        if len(batch) == batch_size:
+            table = create_kmer_table(batch, k, id, 1, canonical, solid)
+            id += len(table)
+            batch = {}
+            yield table
+    if batch:
+        yield create_kmer_table(batch, k, id, 1, canonical, solid)
 
 
-def create_contig_kmers(contigs, k):
+def collect_kmers(tables, codes):
+    """
+    keep only the kmers with the given codes from batches of kmers
+
+    Args:
+        tables (iterable): instances of class KmerTable, such as those made by iter_kmer_tables
+        codes (iterable): kmer codes to keep, in either orientation for canonical tables
+
+    Returns:
+        KmerTable: the kmers with the given codes from all batches
+    """
+    read_ids = []
+    columns = {"read_index": [], "id": [], "code": [], "start": [], "direction": []}
+    k = None
+    canonical = False
+    wanted = None
+    for table in tables:
+        if wanted is None:
+            k = table.k
+            canonical = table.canonical
+            if canonical:
+                codes = [canonical_code(code, k)[0] for code in codes]
+            wanted = np.array(sorted(set(codes)), dtype=kmer_dtype(k))
+        keep = np.isin(table.code, wanted)
+        columns["read_index"].append(table.read_index[keep] + len(read_ids))
+        for column in ["id", "code", "start", "direction"]:
+            columns[column].append(getattr(table, column)[keep])
+        read_ids.extend(table.read_ids)
+    if wanted is None:
+        return KmerTable([], [], [], [], [], [], k)
+    return KmerTable(
+        read_ids,
+        np.concatenate(columns["read_index"]),
+        np.concatenate(columns["id"]),
+        np.concatenate(columns["code"]),
+        np.concatenate(columns["start"]),
+        np.concatenate(columns["direction"]),
+        k,
+        canonical,
+    )
+
+
+def index_kmers(kmers):
+    """
+    index kmers by their code
+
+    Args:
+        kmers (list): instances of class Kmer
+
+    Returns:
+        dict: kmer codes (keys) and all instances of class Kmer with that code sorted by id (values)
+    """
+    kmer_index = {}
+    for kmer in kmers:
+        if kmer.code in kmer_index:
+            kmer_index[kmer.code].append(kmer)
+        else:
+            kmer_index[kmer.code] = [kmer]
+    for node_kmers in kmer_index.values():
+        node_kmers.sort(key=lambda x: x.id)
+    return kmer_index
+
+
+def create_contig_kmers(contigs, k, lazy=False):
     """
     create kmers of contigs
 
     Args:
         contigs (list): instances of class Contigs assembled from reads
         k (int): size of kmers
+        lazy (bool): if True, return a generator that makes the kmers as they are needed
 
     Returns:
         list: instances of class Kmer assembled from all contigs
     """
-    kmers = []
+    kmers = iter_contig_kmers(contigs, k)
+    if lazy:
+        return kmers
+    return list(kmers)
+
+
+def iter_contig_kmers(contigs, k):
+    """
+    generator version of create_contig_kmers
+
+    Args:
+        contigs (iterable): instances of class Contigs assembled from reads
+        k (int): size of kmers
+
+    Yields:
+        Kmer: kmers of each contig in order
+    """
     id = 0
     for contig in contigs:
-        contig_sequence = contig.sequence
-        for i in range(len(contig_sequence) - k + 1):
-            start = i
-            stop = i + k
-            sequence = contig_sequence[start:stop]
-            prefix = sequence[:-1]
-            sufix = sequence[1:]
-            kmer = Kmer(contig.contig_id, id, sequence, prefix, sufix, start, stop, 1)
-            kmers.append(kmer)
+        for start, code in encode_kmers(contig.sequence, k):
+            yield Kmer(contig.contig_id, id, code, k, start, start + k, 1)
             id += 1
-    return kmers
@@ -30,3 +30,40 @@ def format_aln_file(longest_contig, out_dir):
 def save_required_ouputs(contigs, out_dir):
     longest_contig = get_longest_contig(contigs, out_dir)
     format_aln_file(longest_contig, out_dir)
+
+
+def save_query_outputs(query_results, out_dir):
+    """
+    save the outputs of each query in its own directory and a summary of all queries
+
+    Args:
+        query_results (dict): query ids (keys) and touples of the output directory and aligned contigs (values)
+        out_dir (str): directory to save the summary in
+    """
+    summary = []
+    for query_id, (query_dir, contigs) in query_results.items():
+        if contigs:
+            longest_contig = get_longest_contig(contigs, query_dir)
+            format_aln_file(longest_contig, query_dir)
+            summary.append(
+                [
+                    query_id,
+                    query_dir,
+                    len(contigs),
+                    longest_contig.contig_id,
+                    len(longest_contig.sequence),
+                ]
+            )
+        else:
+            summary.append([query_id, query_dir, 0, "", ""])
+    summary = pd.DataFrame(
+        summary,
+        columns=[
+            "query_id",
+            "output_dir",
+            "aligned_contigs",
+            "longest_contig_id",
+            "longest_contig_length",
+        ],
+    )
+    summary.to_csv(f"{out_dir}/query_summary.csv", index=False)
@@ -3,22 +3,89 @@ Here we are testing the core functions of the program
 """
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 import pandas as pd
 
 sys.path.append(os.path.abspath("../"))
-from alignment import alignment, compare_sequences, get_contigs_to_align, score_matches
-from assembly import Contig, assemble_contigs, get_contig_kmers
-from data_loader import parse_query, parse_reads
+from alignment import (
+    NoAlignmentError,
+    align_queries,
+    align_sequences,
+    alignment,
+    banded_local_score,
+    banded_local_score_numpy,
+    best_local_score,
+    best_local_score_numpy,
+    cannot_reach,
+    cigar_string,
+    compare_sequences,
+    fill_score_matrix,
+    fill_score_matrix_numpy,
+    find_contig_seeds,
+    find_seeds,
+    get_contigs_to_align,
+    global_traceback,
+    hirschberg,
+    index_contig_kmers,
+    index_query_kmers,
+    length_batches,
+    min_shared_kmers,
+    query_directories,
+    score_contigs,
+    score_matches,
+    seed_band,
+    trace_alignment,
+)
+from assembly import Contig, assemble_contigs, assembly, get_contig_kmers
+from cache import (
+    StageCache,
+    arrays_to_contigs,
+    arrays_to_paths,
+    cached_stage,
+    contigs_to_arrays,
+    paths_to_arrays,
+    stage_key,
+)
+from data_loader import (
+    IndexedReads,
+    parse_queries,
+    parse_query,
+    parse_reads,
+    read_fasta,
+    validate_sequences,
+)
 from graph import (
+    Paths,
+    compact_graph,
     create_adjacency_matrix,
     create_graph,
+    create_sparse_graph,
+    create_streamed_graph,
+    create_table_graph,
     find_all_paths,
     find_start_stop_nodes,
+    graph_traversal,
 )
-from kmers import create_query_kmers, create_reads_kmers
+from kmers import (
+    count_kmers,
+    create_kmer_table,
+    create_query_kmers,
+    create_reads_kmers,
+    decode_kmer,
+    encode_kmer,
+    encode_kmers,
+    get_all_kmers,
+    index_kmers,
+    iter_kmer_tables,
+    kmer_spectrum,
+    reverse_complement,
+    reverse_complement_code,
+)
+from output import save_query_outputs
 
 
 class TestDataLoaderFunctions(unittest.TestCase):
@@ -32,11 +99,35 @@ class TestDataLoaderFunctions(unittest.TestCase):
         """
         test that the expected ouput is returned
         """
-        fwd_read_dict, rvs_read_dict = parse_reads("testing/test_data/true_reads.txt")
-        expected_fwd_output = {"seq1": "ATGC", "seq2": "GCC"}
-        expected_rvs_output = {"seq1": "CGTA", "seq2": "CCG"}
-        self.assertEqual(fwd_read_dict, expected_fwd_output)
-        self.assertEqual(rvs_read_dict, expected_rvs_output)
+        read_dict = parse_reads("testing/test_data/true_reads.txt")
+        expected_output = {"seq1": "ATGC", "seq2": "GCC"}
+        self.assertEqual(read_dict, expected_output)
+
+    def test_reads_wrapped(self):
+        """
+        test that sequences wrapped over several lines are joined, including gzipped files
+        """
+        expected_output = [("seq1", "ATGCATGCA"), ("seq2", "GCCTA")]
+        for fp in [
+            "testing/test_data/wrapped_reads.txt",
+            "testing/test_data/wrapped_reads.txt.gz",
+        ]:
+            self.assertEqual(list(read_fasta(fp)), expected_output)
+            read_dict = parse_reads(fp)
+            self.assertEqual(read_dict, dict(expected_output))
+
+    def test_indexed_reads(self):
+        """
+        test that indexed reads match the parsed reads and that the saved index is reused
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fp = os.path.join(tmp_dir, "reads.fasta")
+            shutil.copy("testing/test_data/wrapped_reads.txt", fp)
+            reads = IndexedReads(fp)
+            read_dict = parse_reads(fp)
+            self.assertEqual(dict(reads), read_dict)
+            self.assertTrue(os.path.exists(fp + ".index"))
+            self.assertEqual(IndexedReads(fp).index, reads.index)
 
     def test_reads_length_fail(self):
         """
@@ -66,6 +157,27 @@ class TestDataLoaderFunctions(unittest.TestCase):
         """
         self.assertRaises(Exception, parse_reads, "testing/test_data/read_DNA_fail.txt")
 
+    def test_validate_sequences(self):
+        """
+        test that invalid bases are reported with their record and position,
+        including sequences that only contain some valid bases
+        """
+        records = [("seq1", "ATGC"), ("seq2", "ANN")]
+        with self.assertRaisesRegex(Exception, "'N' in seq2 at position 1"):
+            validate_sequences(records, "Reads must be DNA sequences")
+        validate_sequences(records, "Reads must be DNA sequences", allow_n=True)
+        self.assertRaises(
+            Exception,
+            validate_sequences,
+            [("seq1", "ANH")],
+            "Reads must be DNA sequences",
+            True,
+        )
+        # records are checked in chunks as they arrive, the first invalid base is still reported
+        records = ((f"seq{i}", "ACGT" if i != 7 else "ACXT") for i in range(10))
+        with self.assertRaisesRegex(Exception, "'X' in seq7 at position 2"):
+            validate_sequences(records, "Reads must be DNA sequences", chunk_size=6)
+
     def test_query_true(self):
         """
         test that the expected output is returned
@@ -94,6 +206,17 @@ class TestDataLoaderFunctions(unittest.TestCase):
         """
         self.assertRaises(Exception, parse_query, "testing/test_data/true_reads.txt")
 
+    def test_queries_true(self):
+        """
+        test that every query in the file is returned in order
+        """
+        query_dict = parse_queries("testing/test_data/true_reads.txt")
+        expected_output = {"seq1": "ATGC", "seq2": "GCC"}
+        self.assertEqual(query_dict, expected_output)
+        self.assertEqual(
+            parse_queries("testing/test_data/true_query.txt"), {"seq1": "ACTG"}
+        )
+
     def test_query_DNA_fail(self):
         """
         test that an exception is raised if the file contains any letters
@@ -144,6 +267,104 @@ class TestKmerClasses(unittest.TestCase):
         self.assertEqual(kmer.direction, expected_direction)
         self.assertEqual(kmer_order, expected_order)
 
+    def test_index_kmers(self):
+        """
+        test that kmers are indexed by code and sorted by id
+        """
+        kmers = create_reads_kmers({"seq1": "ACTACT", "seq2": "TACT"}, 3, 0, 1)
+        kmer_index = index_kmers(kmers[0][::-1])
+        self.assertEqual(
+            [decode_kmer(code, 3) for code in kmer_index], ["ACT", "TAC", "CTA"]
+        )
+        self.assertEqual(
+            [kmer.id for kmer in kmer_index[encode_kmer("ACT")]], [0, 3, 5]
+        )
+
+    def test_encode_kmers(self):
+        """
+        test the two bit encoding of kmers
+        """
+        self.assertEqual(encode_kmer("ACGT"), 0b00011011)
+        self.assertEqual(decode_kmer(encode_kmer("GATTACA"), 7), "GATTACA")
+        self.assertLess(encode_kmer("ACGT"), encode_kmer("AGCT"))
+        codes = list(encode_kmers("GATTACA", 3))
+        expected_output = [(i, encode_kmer("GATTACA"[i : i + 3])) for i in range(5)]
+        self.assertEqual(codes, expected_output)
+
+    def test_masked_kmers(self):
+        """
+        test that kmers containing an N are skipped
+        """
+        kmers = create_reads_kmers({"seq1": "ACNGACT"}, 3, 0, 1)
+        kmer_order = [kmer.sequence for kmer in kmers[0]]
+        self.assertEqual(kmer_order, ["GAC", "ACT"])
+
+    def test_kmer_table(self):
+        """
+        test that a kmer table holds the same kmers as create_reads_kmers
+        """
+        reads = {"seq1": "ACNGACT", "seq2": "TACT"}
+        kmers = create_reads_kmers(reads, 3, 2, 1)[0]
+        table = create_kmer_table(reads, 3, 2, 1)
+        self.assertEqual(len(table), 4)
+        self.assertEqual(list(table.id), [2, 3, 4, 5])
+        self.assertEqual(list(table.start), [3, 4, 0, 1])
+        for kmer, row in zip(kmers, table):
+            self.assertEqual(row.read_id, kmer.read_id)
+            self.assertEqual(row.sequence, kmer.sequence)
+            self.assertEqual(row.stop, kmer.stop)
+        self.assertEqual([kmer.id for kmer in table.get(encode_kmer("ACT"))], [3, 5])
+        self.assertIsNone(table.get(encode_kmer("AAA")))
+
+    def test_canonical_kmers(self):
+        """
+        test that a read and its reverse complement give the same canonical kmers
+        """
+        self.assertEqual(
+            reverse_complement_code(encode_kmer("AACG"), 4), encode_kmer("CGTT")
+        )
+        reads = {"seq1": "AACGT", "seq2": "ACGTT"}
+        kmers = create_reads_kmers(reads, 4, 0, 1, canonical=True)[0]
+        self.assertEqual(
+            [kmer.sequence for kmer in kmers], ["AACG", "ACGT", "ACGT", "AACG"]
+        )
+        self.assertEqual([kmer.direction for kmer in kmers], [1, 1, 1, -1])
+        table = create_kmer_table(reads, 4, 0, 1, canonical=True)
+        self.assertEqual([int(code) for code in table.code], [k.code for k in kmers])
+        self.assertEqual(list(table.direction), [1, 1, 1, -1])
+        self.assertEqual(len(table.get(encode_kmer("CGTT"))), 2)
+
+    def test_count_kmers(self):
+        """
+        test kmer counting in batches, the kmer spectrum and dropping rare kmers
+        """
+        reads = {"seq1": "ACTACT", "seq2": "TACT", "seq3": "GGG"}
+        codes, counts = count_kmers(reads, 3, batch_size=2)
+        self.assertEqual(
+            [decode_kmer(int(code), 3) for code in codes], ["ACT", "CTA", "GGG", "TAC"]
+        )
+        self.assertEqual(list(counts), [3, 1, 1, 2])
+        self.assertEqual(kmer_spectrum(counts), {1: 2, 2: 1, 3: 1})
+        table = create_kmer_table(reads, 3, 0, 1, solid=codes[counts >= 2])
+        self.assertEqual(
+            [kmer.sequence for kmer in table], ["ACT", "TAC", "ACT", "TAC", "ACT"]
+        )
+
+    def test_lazy_kmers(self):
+        """
+        test that lazy kmers match the kmers made all at once
+        """
+        kmers = create_query_kmers("ACTGA", 3, lazy=True)
+        self.assertFalse(isinstance(kmers, list))
+        self.assertEqual(
+            [kmer.sequence for kmer in kmers],
+            [kmer.sequence for kmer in create_query_kmers("ACTGA", 3)],
+        )
+        reads = {"seq1": "ACTACT", "seq2": "TACT", "seq3": "GGG"}
+        tables = list(iter_kmer_tables(reads, 3, batch_size=2))
+        self.assertEqual([len(table) for table in tables], [6, 1])
+        self.assertEqual(list(tables[1].id), [6])
+
     def test_query_kmers(self):
         """
         test the creation of kmers from query sequence
@@ -204,6 +425,56 @@ class TestGraphFunctions(unittest.TestCase):
         expected_output.index = ["ACT", "CTG", "TGA", "GAC"]
         self.assertEqual(adj_matrix.equals(expected_output), True)
 
+    def test_sparse_graph(self):
+        """
+        test the creation of a sparse graph from an edge list
+        """
+        kmers = create_reads_kmers({"seq1": "ACTGAC"}, 3, 0, 1)
+        edges = create_graph(kmers[0])
+        graph = create_sparse_graph(kmers[0], edges)
+        self.assertEqual(
+            graph.nodes, [encode_kmer(x) for x in ["ACT", "CTG", "TGA", "GAC"]]
+        )
+        self.assertEqual(graph.sequence(3), "GAC")
+        self.assertEqual(graph.successors, [[1], [2], [3], []])
+        self.assertEqual(list(graph.in_degree), [0, 1, 1, 1])
+        self.assertEqual(list(graph.out_degree), [1, 1, 1, 0])
+
+    def test_table_graph(self):
+        """
+        test that a graph built from a kmer table matches the sparse graph
+        """
+        reads = {"seq1": "ACTGAC", "seq2": "CTGAA"}
+        kmers = create_reads_kmers(reads, 3, 0, 1)[0]
+        graph = create_sparse_graph(kmers, create_graph(kmers))
+        table_graph = create_table_graph(create_kmer_table(reads, 3, 0, 1))
+        self.assertEqual(table_graph.nodes, graph.nodes)
+        self.assertEqual(table_graph.successors, graph.successors)
+
+    def test_streamed_graph(self):
+        """
+        test that a graph built from batches of kmers matches the graph of all kmers
+        """
+        reads = {"seq1": "ACTGAC", "seq2": "CTGAA", "seq3": "GACT"}
+        graph = create_table_graph(create_kmer_table(reads, 3, 0, 1))
+        streamed_graph = create_streamed_graph(iter_kmer_tables(reads, 3, batch_size=1))
+        self.assertEqual(streamed_graph.nodes, graph.nodes)
+        self.assertEqual(streamed_graph.successors, graph.successors)
+
+    def test_compact_graph(self):
+        """
+        test that non-branching chains are collapsed into unitigs
+        """
+        kmers = create_reads_kmers({"seq1": "ACTGAC"}, 3, 0, 1)
+        edges = create_graph(kmers[0])
+        unitigs = compact_graph(create_sparse_graph(kmers[0], edges))
+        self.assertEqual(unitigs.nodes, ["ACTGAC"])
+        self.assertEqual(unitigs.members, [[0, 1, 2, 3]])
+        paths = list(find_all_paths(unitigs))
+        self.assertEqual(
+            paths[0].path, [encode_kmer(x) for x in ["ACT", "CTG", "TGA", "GAC"]]
+        )
+
     def test_start_stop_nodes(self):
         """
         test to find all possible start and stop nodes
@@ -268,6 +539,22 @@ class TestGraphFunctions(unittest.TestCase):
         expected_output = [["ACT", "CTG", "TGA", "GAC"]]
         self.assertEqual(path_sequence, expected_output)
 
+    def test_find_paths_limit(self):
+        """
+        test that path finding stops once the maximum number of paths is reached
+        """
+        adj_matrix = pd.DataFrame(
+            {
+                "ACT": [0, 0, 0],
+                "CTG": [1, 0, 0],
+                "CTA": [1, 0, 0],
+            }
+        )
+        adj_matrix.index = ["ACT", "CTG", "CTA"]
+        self.assertEqual(len(list(find_all_paths(adj_matrix))), 2)
+        paths = list(find_all_paths(adj_matrix, max_paths=1))
+        self.assertEqual(len(paths), 1)
+
 
 class TestAssemblyFuncions(unittest.TestCase):
     """
@@ -318,6 +605,18 @@ class TestAssemblyFuncions(unittest.TestCase):
         expected_sequence = "ACTGAC"
         self.assertEqual(sequence, expected_sequence)
 
+    def test_assemble_canonical(self):
+        """
+        test that reads from opposite strands are assembled into one contig
+        """
+        reads = {"seq1": "ACTGACC", "seq2": "TTGGTCA"}
+        # kmers are streamed in batches twice, like the pipeline in main.py
+        paths = graph_traversal(
+            get_all_kmers(reads, 4, canonical=True, lazy=True), False, None
+        )
+        contigs = assembly(paths, get_all_kmers(reads, 4, canonical=True, lazy=True))
+        self.assertEqual([contig.sequence for contig in contigs], ["ACTGACCAA"])
+
 
 class TestAlignmentFunctions(unittest.TestCase):
     """
@@ -356,6 +655,147 @@ class TestAlignmentFunctions(unittest.TestCase):
         expected_output = (None, False)
         self.assertEqual(alignment, expected_output)
 
+    def test_numpy_engine(self):
+        """
+        test that the numpy engine fills the same score matrix as the python engine
+        """
+        for query, sequence in [
+            ("ACTGAC", "ACTTGAC"),
+            ("ACTG", "CGAT"),
+            ("AAAT", "TA"),
+        ]:
+            expected_output = fill_score_matrix(query, sequence, 2, -1, -3)
+            scores = fill_score_matrix_numpy(query, sequence, 2, -1, -3)
+            self.assertEqual(scores.tolist(), expected_output.tolist())
+        alignment = compare_sequences("ACTG", "ACTG", 1, -1, -1, 0, "numpy")
+        self.assertEqual(alignment, (1, True))
+
+    def test_score_only(self):
+        """
+        test that keeping two rows gives the same best score as the full matrix
+        """
+        for query, sequence in [
+            ("ACTGAC", "ACTTGAC"),
+            ("ACTG", "CGAT"),
+            ("AAAT", "TA"),
+        ]:
+            expected_output = fill_score_matrix(query, sequence, 2, -1, -3).max()
+            self.assertEqual(
+                best_local_score(query, sequence, 2, -1, -3), expected_output
+            )
+            self.assertEqual(
+                best_local_score_numpy(query, sequence, 2, -1, -3), expected_output
+            )
+        alignment = compare_sequences("ACTG", "CGAT", 1, -1, -1, 0.5, "numpy", True)
+        self.assertEqual(alignment, (None, False))
+
+    def test_banded_alignment(self):
+        """
+        test that banded extension around the seeds finds the alignment on the seed diagonals
+        """
+        self.assertEqual(seed_band([(0, 2), (3, 6)], 2), (0, 5))
+        self.assertIsNone(seed_band([(0, 2), (9, 1)], 2))
+        self.assertIsNone(seed_band([], 2))
+        query = "GGACTGACTT"
+        sequence = "CCACTGACTTCC"
+        expected_output = fill_score_matrix(query, sequence, 1, -1, -1).max()
+        for engine in [banded_local_score, banded_local_score_numpy]:
+            self.assertEqual(engine(query, sequence, 1, -1, -1, -1, 1), expected_output)
+            # the band only holds the diagonal of the first row and column
+            self.assertEqual(engine(query, sequence, 1, -1, -1, -20, -9), 0)
+        seeds = find_seeds(index_query_kmers(query, 4), sequence, 4)
+        self.assertEqual(
+            compare_sequences(query, sequence, 1, -1, -1, 0.5, "numpy", True, 1, seeds),
+            compare_sequences(query, sequence, 1, -1, -1, 0.5, "numpy", True),
+        )
+
+    def test_batch_alignment(self):
+        """
+        test that contigs aligned in batches get the same scores as one at a time
+        """
+        sequences = ["ACTGA", "TTTTTTTTTT", "ACT", "ACTGACTGAC", "GAC"]
+        self.assertEqual(length_batches(sequences, batch_size=2), [[2, 4], [0], [1, 3]])
+        query = "ACTGACTT"
+        self.assertEqual(
+            score_contigs(query, sequences, 2, -1, -3, 0.5, "batch"),
+            score_contigs(query, sequences, 2, -1, -3, 0.5, "numpy"),
+        )
+
+    def test_alignment_pruning(self):
+        """
+        test that alignments are only stopped early when they cannot pass the threshold
+        """
+        self.assertTrue(cannot_reach(1, 0, 2, 1, 3.5))
+        self.assertFalse(cannot_reach(1, 2, 2, 1, 3.5))
+        self.assertFalse(cannot_reach(1, 0, 2, 1, None))
+        # 8 bases with one error share 8 - 3 + 1 - 3 = 3 3-mers, the bound is rounded down
+        self.assertEqual(min_shared_kmers(8, 8, 3, 1, -1, -1, 7 / 8), 2)
+        self.assertEqual(min_shared_kmers(8, 8, 3, 1, -1, -1, 0), 0)
+        self.assertEqual(min_shared_kmers(8, 8, 3, 1, 0, -1, 7 / 8), 0)
+        self.assertEqual(min_shared_kmers(8, 8, 3, 1, -1, 1, 7 / 8), 0)
+        self.assertEqual(min_shared_kmers(8, 8, 3, 1, -1, 2, 7 / 8), 0)
+        # a mismatch scoring above a match breaks the bounds, so nothing is pruned
+        for engine in ["python", "numpy"]:
+            self.assertEqual(
+                align_sequences("AAAA", "CCCC", 1, -1, 2, 1.5, engine, True),
+                align_sequences("AAAA", "CCCC", 1, -1, 2, 1.5, engine),
+            )
+        self.assertEqual(
+            score_contigs("AAAA", ["CCCC"], 1, -1, 2, 1.5, "batch"),
+            [(2.0, True, False)],
+        )
+        contig = [Contig(1, {}, "CCCCC", 1)]
+        for engine in ["python", "numpy", "batch"]:
+            self.assertEqual(
+                alignment("AAAAC", contig, 1, 1, -1, 2, 1.5, False, None, engine),
+                contig,
+            )
+        # kmers with an N give no seeds, but N still matches N in the alignment
+        query = "ACGTTGCA" + "N" * 32 + "ACGGTACCA"
+        contig = [Contig(1, [0, 1, 2], query, 1)]
+        for engine in ["python", "numpy", "batch"]:
+            self.assertEqual(
+                alignment(query, contig, 5, 1, -1, -1, 0.9, False, None, engine),
+                contig,
+            )
+        query = "ACTGACTT"
+        sequence = "GGCCGGCC"
+        for engine in [best_local_score, best_local_score_numpy]:
+            self.assertIsNone(engine(query, sequence, 1, -1, -1, 7))
+            self.assertEqual(engine(query, sequence, 1, -1, -1, 1), 1)
+        for engine in ["python", "numpy"]:
+            self.assertEqual(
+                align_sequences(query, sequence, 1, -1, -1, 0.9, engine, True),
+                (None, False, True),
+            )
+            self.assertEqual(
+                align_sequences(query, query, 1, -1, -1, 0.9, engine, True),
+                (1.0, True, False),
+            )
+        self.assertEqual(
+            score_contigs(query, [sequence, query], 1, -1, -1, 0.9, "batch"),
+            [(None, False, True), (1.0, True, False)],
+        )
+
+    def test_find_contig_seeds(self):
+        """
+        test that seeds found from the contig index match those found by scanning each contig
+        """
+        contigs = [
+            Contig(1, [0, 1, 2], "GACTT", 1),
+            Contig(2, [0, 1, 2], "TTTTT", 1),
+            Contig(3, [0, 1, 2], "CTGACTG", 1),
+        ]
+        query = "ACTGACT"
+        contig_index = index_contig_kmers(contigs, 3)
+        query_index = index_query_kmers(query, 3)
+        expected_output = [
+            find_seeds(query_index, contig.sequence, 3) for contig in contigs
+        ]
+        self.assertEqual(
+            find_contig_seeds(contig_index, query, 3, len(contigs)), expected_output
+        )
+
     def test_get_contigs_to_align(self):
         """
         test function to get sequences to align based on kmer matches to the query
@@ -365,6 +805,15 @@ class TestAlignmentFunctions(unittest.TestCase):
         expected_output = contig
         self.assertEqual(contigs_to_align, expected_output)
 
+    def test_find_seeds(self):
+        """
+        test that all kmer matches between a contig and the query are found
+        """
+        query_index = index_query_kmers("ACTGACT", 3)
+        seeds = find_seeds(query_index, "GACTT", 3)
+        expected_output = [(3, 0), (0, 1), (4, 1)]
+        self.assertEqual(seeds, expected_output)
+
     def test_no_contigs_to_align(self):
         """
         test that an exception is raised if their are no reads with kmer matches to query
@@ -381,14 +830,239 @@ class TestAlignmentFunctions(unittest.TestCase):
         expected_output = contig
         self.assertEqual(aligned_reads, expected_output)
 
+    def test_alignment_workers(self):
+        """
+        test that aligning with several processes gives the same contigs in the same order
+        """
+        contigs = [
+            Contig(1, [0, 1, 2], "ACTGAC", 1),
+            Contig(2, [0, 1, 2], "TTACTGA", 1),
+            Contig(3, [0, 1, 2], "GACTTT", 1),
+        ]
+        expected_output = alignment(
+            "ACTGAC", contigs, 3, 1, -1, -1, 0.5, False, None, "numpy"
+        )
+        aligned_contigs = alignment(
+            "ACTGAC", contigs, 3, 1, -1, -1, 0.5, False, None, "numpy", 2
+        )
+        self.assertEqual(aligned_contigs, expected_output)
+
+    def test_trace_alignment(self):
+        """
+        test that the coordinates and CIGAR string of the best local alignment are found
+        """
+        self.assertEqual(cigar_string(["=", "=", "X", "D", "D", "="]), "2=1X2D1=")
+        query = "GGACTGACTTGG"
+        sequence = "CCACTGCTTCC"
+        self.assertEqual(
+            hirschberg("ACTGACTT", "ACTGCTT", 1, -1, -1),
+            global_traceback("ACTGACTT", "ACTGCTT", 1, -1, -1),
+        )
+        self.assertEqual(
+            trace_alignment(query, sequence, 1, -1, -1), (2, 10, 2, 9, "4=1D3=")
+        )
+        self.assertEqual(trace_alignment("AAA", "CCC", 1, -1, -1), (0, 0, 0, 0, ""))
+        contig = [Contig(1, [0, 1, 2], sequence, 1)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            alignment(query, contig, 3, 1, -1, -1, 0.5, False, tmp_dir, traceback=True)
+            scores = pd.read_csv(f"{tmp_dir}/alignment_scores.csv", header=None)
+        self.assertEqual(scores.values.tolist(), [[1, 6 / 11, 2, 10, 2, 9, "4=1D3="]])
+
+    def test_align_queries(self):
+        """
+        test that each query gets its own aligned contigs and output directory
+        """
+        contigs = [
+            Contig(1, [0, 1, 2], "ACTGAC", 1),
+            Contig(2, [0, 1, 2], "GGTTCCA", 1),
+        ]
+        query_dict = {"query 1": "ACTGAC", "query2": "GGTTCC", "query3": "AAAAAA"}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            query_results = align_queries(
+                query_dict, contigs, 3, 1, -1, -1, 0.5, False, tmp_dir
+            )
+            self.assertTrue(os.path.isdir(f"{tmp_dir}/query_1"))
+            query_dirs = query_directories(tmp_dir, ["q 1", "q/1", "q_1_2"])
+            self.assertEqual(
+                [os.path.basename(query_dir) for query_dir in query_dirs.values()],
+                ["q_1", "q_1_2", "q_1_2_2"],
+            )
+            for query_id in [".", "..", ""]:
+                self.assertRaises(Exception, query_directories, tmp_dir, [query_id])
+            # ids named like the files of the run do not replace them with a directory
+            query_dirs = query_directories(
+                tmp_dir, ["query_summary.csv", "Kmer_Spectrum.csv"]
+            )
+            self.assertEqual(
+                [os.path.basename(query_dir) for query_dir in query_dirs.values()],
+                ["query_summary.csv_2", "Kmer_Spectrum.csv_2"],
+            )
+            summary_results = align_queries(
+                {"query_summary.csv": "ACTGAC"},
+                contigs,
+                3,
+                1,
+                -1,
+                -1,
+                0.5,
+                False,
+                tmp_dir,
+            )
+            save_query_outputs(summary_results, tmp_dir)
+            self.assertTrue(os.path.isfile(f"{tmp_dir}/query_summary.csv"))
+            self.assertTrue(
+                os.path.isfile(f"{tmp_dir}/query_summary.csv_2/ALLELES.fasta")
+            )
+        expected_output = {
+            "query 1": [contigs[0]],
+            "query2": [contigs[1]],
+            "query3": [],
+        }
+        self.assertEqual(
+            {key: value[1] for key, value in query_results.items()}, expected_output
+        )
+
+    def test_alignment_canonical(self):
+        """
+        test that a contig kept on the other strand than the query is still aligned
+        """
+        sequence = "GGATCACAGTCTACACTGCTCACTCCAACCCCGGCCCCTGAGTCCGAGGAGAGGGTGCTT"
+        reads = {f"seq{i}": sequence[i * 5 : i * 5 + 20] for i in range(9)}
+        paths = graph_traversal(
+            get_all_kmers(reads, 7, canonical=True, lazy=True), False, None
+        )
+        contigs = assembly(paths, get_all_kmers(reads, 7, canonical=True, lazy=True))
+        # only the strand of the reads is kept as a contig, the query is the other one
+        self.assertEqual([contig.sequence for contig in contigs], [sequence])
+        query = reverse_complement(sequence)
+        self.assertRaises(
+            NoAlignmentError,
+            alignment,
+            query,
+            contigs,
+            7,
+            1,
+            -1,
+            -1,
+            0.9,
+            False,
+            None,
+        )
+        for engine in ["python", "batch"]:
+            aligned_contigs = alignment(
+                query,
+                contigs,
+                7,
+                1,
+                -1,
+                -1,
+                0.9,
+                False,
+                None,
+                engine,
+                canonical=True,
+            )
+            self.assertEqual(aligned_contigs, contigs)
+            self.assertEqual(aligned_contigs[0].direction, -1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            query_results = align_queries(
+                {"query": query},
+                contigs,
+                7,
+                1,
+                -1,
+                -1,
+                0.9,
+                False,
+                tmp_dir,
+                canonical=True,
+            )
+        self.assertEqual(query_results["query"][1], contigs)
+
     def test_alignment_false(self):
         """
         test that an exception is raised if no reads align to query
         """
         contig = [Contig(1, [0, 1, 2], "TACGA", 1)]
         self.assertRaises(
-            Exception, alignment, "ACTGAC", contig, 3, 1, -1, -1, 0.5, False, None
+            NoAlignmentError,
+            alignment,
+            "ACTGAC",
+            contig,
+            3,
+            1,
+            -1,
+            -1,
+            0.5,
+            False,
+            None,
         )
 
 
+class TestCacheFunctions(unittest.TestCase):
+    """
+    Tests for the on disk cache of pipeline stages
+    """
+
+    def test_cache_round_trip(self):
+        """
+        test that contigs and paths are the same after storing them as arrays
+        """
+        reads = {
+            "read1": {
+                "sseqid": "read1",
+                "qseqid": 4,
+                "sstart": 0,
+                "send": 5,
+                "qstart": 0,
+                "qend": 5,
+            }
+        }
+        contigs = [Contig(4, reads, "ACTGAC", 1), Contig(7, {}, "GGA", 1)]
+        contigs_out = arrays_to_contigs(contigs_to_arrays(contigs))
+        self.assertEqual(
+            [(c.contig_id, c.aligned_reads, c.sequence, c.direction) for c in contigs],
+            [
+                (c.contig_id, c.aligned_reads, c.sequence, c.direction)
+                for c in contigs_out
+            ],
+        )
+        paths = [Paths(0, 1, 3, [1, 2, 3]), Paths(1, 5, 5, [5])]
+        paths_out = arrays_to_paths(paths_to_arrays(paths))
+        self.assertEqual(
+            [(p.contig_id, p.start_node, p.stop_node, p.path) for p in paths],
+            [(p.contig_id, p.start_node, p.stop_node, p.path) for p in paths_out],
+        )
+        # kmers longer than 32 bases do not fit in the arrays
+        self.assertIsNone(paths_to_arrays([Paths(0, 1, 1 << 70, [1, 1 << 70])]))
+
+    def test_stage_cache(self):
+        """
+        test that stages are loaded from the cache and the least recently used entries are removed
+        """
+        runs = []
+
+        def run():
+            runs.append(1)
+            return [Paths(0, 1, 2, [1, 2])]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = StageCache(tmp_dir, 10**6)
+            key = stage_key("paths", "reads", 3)
+            self.assertNotEqual(key, stage_key("paths", "reads", 4))
+            for _ in range(2):
+                paths = cached_stage(cache, key, run, paths_to_arrays, arrays_to_paths)
+            self.assertEqual(len(runs), 1)
+            self.assertEqual(paths[0].path, [1, 2])
+            cached_stage(cache, key, run, paths_to_arrays, arrays_to_paths, True)
+            self.assertEqual(len(runs), 2)
+            other_key = stage_key("paths", "reads", 4)
+            cache.save(other_key, paths_to_arrays(paths))
+            os.utime(cache.path(key), (0, 0))
+            cache.max_bytes = os.path.getsize(cache.path(other_key))
+            self.assertEqual(cache.evict(), 1)
+            self.assertIsNone(cache.load(key))
+            self.assertIsNotNone(cache.load(other_key))
+
+
 # python3 -m unittest testing.test_core